@@ -1,16 +1,25 @@
-import json
+import hashlib
+import logging
 import os
 import re
 import sys
-import mimetypes
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
-# from PIL import Image
-import codecs
 
 import sublime
 import sublime_plugin
 
+try:
+    import sqlite3
+    PAGE_STORE = True
+except ImportError:
+    PAGE_STORE = False
+
 try:
     import lxml.html
     from lxml import etree
@@ -21,7 +30,9 @@ except ImportError:
 
 abspath = os.path.abspath(os.path.dirname(__file__))
 sys.path.append(abspath)
-import markdown2
+import confluence_core
+from confluence_core import (ConfluenceApi, FolderPublisher, PageStore, RetryPolicy, SqliteStore, StorageDiff,
+                             TokenBucket, UnchangedPage)
 
 
 def debug_tab(sublime, content, header=""):
@@ -36,234 +47,523 @@ def debug_tab(sublime, content, header=""):
     new_view_source.run_command("expand_tabs", {"set_translate_tabs": True})
 
 
-class ConfluenceApi(object):
-
-    def __init__(self, username, password, base_uri):
-        self.username = username
-        self.password = password
-        self.base_uri = base_uri
-        self.session = requests.Session()
-        self.session.auth = requests.auth.HTTPBasicAuth(self.username, self.password)
-        print("ConfluenceApi username: {}, password: {}, base_uri: {}".format(
-            self.username, "*" * len(self.password), self.base_uri))
-
-    def _request(self, method, sub_uri, params=None, **kwargs):
-        url = "{}/{}".format(self.base_uri, sub_uri)
-
-        headers = {"Content-Type": "application/json"}
-        if "headers" in kwargs:
-            if not kwargs["headers"] is None:
-                headers = kwargs["headers"]  # headers.update(kwargs["headers"])
-            kwargs.pop("headers", None)
-
-        if params:
-            kwargs.update(params=params)
-        # Ensure we are authenticated (set cookie, session, etc.)
-        self.session.request("get", self.base_uri) 
-        # Make the "real" call
-        response = self.session.request(
-            method, url, headers=headers, verify=False, **kwargs)
-        return response
-
-    def _post(self, url, data=None):
-        return self._request("post", url, data=json.dumps(data))
-
-    def _get(self, url, params=None):
-        return self._request("get", url, params=params)
-
-    def _put(self, url, data=None, files=None, headers=None):
-        if data is None:
-            return self._request("put", url, files=files, headers=headers)
-        else:
-            return self._request("put", url, data=json.dumps(data), files=files, headers=headers)
+class SearchPrefixCache(object):
+    """
+    Recent page search results keyed by (space, query). Results of a shorter
+    query narrowed locally are only provisional: CQL title~ matches words,
+    not substrings, so they may miss pages the server would find.
+    """
 
-    def _delete(self, url, params=None):
-        return self._request("delete", url, params=params)
+    def __init__(self, max_entries=200, ttl=120):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.base_uri = None
 
-    def extract_images(self, content_data, source_filename="/"):
-        if HTML_PRETTIFY:
-            doc = lxml.html.fromstring(content_data['body']['storage']['value'])
-
-            file_dir = os.path.dirname(os.path.abspath(source_filename))
-            print("Extract files form: %s \r\n" % file_dir)
-            if not file_dir[-1] in "/\\":
-                if sys.platform == "win32" or sys.platform == "win32":
-                    file_dir += "\\"
-                else:
-                    file_dir += "/"
-
-            resources = []
-
-            for img in doc.xpath('//img'):
-                img.tag = "ac:image"
-                _src = (img.get('src')).replace("%20", " ")
-                img.attrib.clear()
-                # w, h = Image.open(file_dir + _src).size
-                w = 500
-                img.attrib["ac:width"] = "{}".format(min(w, 500))
-                img.attrib["ac:align"] = "center"
-
-                if os.path.isfile(file_dir + _src):
-                    resources.append(dict({"filename": os.path.basename(file_dir + _src),
-                                           "fullpath": file_dir + _src}))
-                    _template = "<ri:attachment ri:filename=\"%s\" />" % os.path.basename(file_dir + _src)
-                    link = lxml.html.fromstring(_template)  # .find('.//attachment')
-                    link.tag = "ri:attachment"
-                    img.insert(1, link)
-
-            _tmp_cont = lxml.html.tostring(doc, pretty_print=True, encoding="utf-8").decode("utf-8")
-            _tmp_cont =  _tmp_cont.replace("[TOC]", "<ac:structured-macro ac:name=\"toc\" ac:schema-version=\"1\" />")
-            _tmp_cont = _tmp_cont.replace("atl_conf_", "ac:")
-            _tmp_cont = _tmp_cont.replace("res_id_", "ri:")
-            content_data['body']['storage']['value'] = _tmp_cont
-
-            return content_data, resources
-        else:
-            return content_data, []
+    def set_server(self, base_uri):
+        """
+        Forget every entry when base_uri changed, their page ids belong to
+        the previous server.
+        """
+        with self.lock:
+            if base_uri != self.base_uri:
+                self.entries.clear()
+            self.base_uri = base_uri
 
-    def upload_child_attachment(self, content_id, attachment_dict):
-        content_type, encoding = mimetypes.guess_type(attachment_dict["fullpath"])
-        if content_type is None:
-            content_type = 'multipart/form-data'
-        return self._put("content/{}/child/attachment".format(content_id),
-                         data=None,
-                         files={"file": (attachment_dict["filename"],
-                                         open(attachment_dict["fullpath"], 'rb'),
-                                         content_type)},
-                         headers={'X-Atlassian-Token': 'no-check'})
+    def put(self, space_key, query, pages, complete, expire=True):
+        """
+        Cache pages for query. Entries put with expire=False, such as the
+        warm-up page list, are kept until replaced instead of for ttl
+        seconds and are never evicted to make room.
+        """
+        expires = time.time() + self.ttl if expire else None
+        with self.lock:
+            self.entries[(space_key, query.lower())] = (expires, pages, complete)
+            self.entries.move_to_end((space_key, query.lower()))
+            expiring = [key for key, (expires, _, _) in self.entries.items() if expires is not None]
+            for key in expiring[:max(0, len(self.entries) - self.max_entries)]:
+                del self.entries[key]
+
+    def _evict_expired(self):
+        now = time.time()
+        for key, (expires, _, _) in list(self.entries.items()):
+            if expires is not None and now > expires:
+                del self.entries[key]
+
+    def get(self, space_key, query):
+        """
+        Return (pages, complete) the server answered for query, or None on a
+        miss.
+        """
+        with self.lock:
+            self._evict_expired()
+            entry = self.entries.get((space_key, query.lower()))
+        return (entry[1], entry[2]) if entry is not None else None
 
-    def create_or_update_attachments(self, content_id, resources):
+    def narrow(self, space_key, query):
+        """
+        Provisional pages for query: the cached results of the longest query
+        it extends whose titles contain every word of query, or None.
+        """
+        query = query.lower()
+        with self.lock:
+            self._evict_expired()
+            prefixes = [key[1] for key in self.entries
+                        if key[0] == space_key and query.startswith(key[1])]
+            if not prefixes:
+                return None
+            _, pages, _ = self.entries[(space_key, max(prefixes, key=len))]
+        terms = query.split()
+        narrowed = [page for page in pages
+                    if all(term in page["title"].lower() for term in terms)]
+        return narrowed or None
 
-        for img in resources:
-            upload_resp = self.upload_child_attachment(content_id, img)
-            if not upload_resp.ok:
-                return upload_resp
 
-        return upload_resp
+SEARCHES = SearchPrefixCache()
 
-    def create_content(self, content_data, filename=None):
 
-        new_content_data, images = self.extract_images(content_data, source_filename=filename)
+class SpaceIndex(SqliteStore):
+    """
+    Local FTS5 full-text index of page titles and plain-text bodies of
+    synced spaces.
+    """
+    SCHEMA = "CREATE VIRTUAL TABLE IF NOT EXISTS page_text USING fts5(id UNINDEXED, space UNINDEXED, title, body)"
+    # page_text rowid of every page id, UNINDEXED columns can only be scanned
+    ROWS_SCHEMA = "CREATE TABLE IF NOT EXISTS page_rows (row INTEGER PRIMARY KEY, id TEXT UNIQUE)"
+    SYNC_SCHEMA = "CREATE TABLE IF NOT EXISTS space_sync (space TEXT PRIMARY KEY, synced_at REAL)"
+
+    def __init__(self, path):
+        super(SpaceIndex, self).__init__(path)
+        self._execute(self.SCHEMA)
+        self._execute(self.ROWS_SCHEMA)
+        self._execute(self.SYNC_SCHEMA)
+
+    def synced_at(self, space_key):
+        rows = self._execute("SELECT synced_at FROM space_sync WHERE space = ?", (space_key,))
+        return rows[0][0] if rows else None
+
+    def mark_synced(self, space_key, synced_at):
+        self._execute("INSERT OR REPLACE INTO space_sync (space, synced_at) VALUES (?, ?)",
+                      (space_key, synced_at))
+
+    def clear(self, space_key):
+        self._executemany([
+            ("DELETE FROM page_rows WHERE row IN (SELECT rowid FROM page_text WHERE space = ?)", (space_key,)),
+            ("DELETE FROM page_text WHERE space = ?", (space_key,)),
+            ("DELETE FROM space_sync WHERE space = ?", (space_key,))])
+
+    def add_pages(self, space_key, pages):
+        """
+        Index pages, replacing their earlier text by rowid.
+        """
+        row = "(SELECT row FROM page_rows WHERE id = ?)"
+        statements = []
+        for page in pages:
+            statements.append(("INSERT OR IGNORE INTO page_rows (id) VALUES (?)", (page["id"],)))
+            statements.append(("DELETE FROM page_text WHERE rowid = " + row, (page["id"],)))
+            statements.append(("INSERT INTO page_text (rowid, id, space, title, body) "
+                               "VALUES (" + row + ", ?, ?, ?, ?)",
+                               (page["id"], page["id"], space_key, page["title"],
+                                storage_to_text(page["body"]["storage"]["value"]))))
+        self._executemany(statements)
+
+    def page_ids(self, space_key):
+        return set(row[0] for row in self._execute("SELECT id FROM page_text WHERE space = ?", (space_key,)))
+
+    def remove_pages(self, page_ids):
+        row = "(SELECT row FROM page_rows WHERE id = ?)"
+        statements = []
+        for page_id in page_ids:
+            statements.append(("DELETE FROM page_text WHERE rowid = " + row, (page_id,)))
+            statements.append(("DELETE FROM page_rows WHERE id = ?", (page_id,)))
+        self._executemany(statements)
+
+    def search(self, space_key, query, limit=500):
+        """
+        Pages of space_key whose title or body contain every word of query
+        as a prefix, best matches first.
+        """
+        terms = ["\"{}\"*".format(term.replace('"', '""')) for term in query.split()]
+        if not terms:
+            return []
+        rows = self._execute(
+            "SELECT id, title FROM page_text WHERE page_text MATCH ? AND space = ? "
+            "ORDER BY rank LIMIT ?", (" ".join(terms), space_key, limit))
+        return [dict(id=row[0], title=row[1]) for row in rows]
 
-        update_content_resp = self._post("content/", data=new_content_data)
-        if not update_content_resp.ok:
-            return update_content_resp, new_content_data
 
-        content_id = self.get_content_id(update_content_resp.json())
-        if images:
-            upload_resp = self.create_or_update_attachments(content_id, images)
-            if upload_resp.ok:
-                return update_content_resp, new_content_data
-            else:
-                return upload_resp, new_content_data
-        else:
-            return update_content_resp, new_content_data
-
-    def search_content(self, space_key, title):
-        cql = "type=page AND space=\"{}\" AND title~\"{}\"".format(space_key, title)
-        params = {"cql": cql}
-        response = self._get("content/search", params=params)
-        return response
-
-    def get_content_by_id(self, content_id):
-        response = self._get(
-            "content/{}?expand=body.storage,version,space".format(content_id))
-        return response
-
-    def get_content_by_title(self, space_key, title):
-        cql = "type=page AND space=\"{}\" AND title=\"{}\"".format(space_key, title)
-        params = {"cql": cql}
-        response = self._get("content/search", params=params)
-        return response
-
-    def get_content_history(self, content_id):
-        return self._get("content/{}/history".format(content_id))
-
-    def get_content_id(self, content):
-        id = content["id"]
-        return "{}".format(id)
-
-    def get_content_uri(self, content):
-        print("Page links: %s" % content["_links"])
-        base = content["_links"]["base"]
-        webui = content["_links"]["webui"]
-        return "{}{}".format(base, webui)
-
-    def update_content(self, content_id, content_data, filename=None):
-
-        new_content_data, images = self.extract_images(content_data, source_filename=filename)
-
-        update_content_resp = self._put("content/{}".format(content_id),
-                                        data=new_content_data)
-        if not update_content_resp.ok:
-            return update_content_resp, new_content_data
-
-        if images:
-            upload_resp = self.create_or_update_attachments(content_id, images)
-            if upload_resp.ok:
-                return update_content_resp, new_content_data
-            else:
-                return upload_resp, new_content_data
-        else:
-            return update_content_resp, new_content_data
+def storage_to_text(body):
+    if HTML_PRETTIFY and body.strip():
+        try:
+            return lxml.html.fromstring(body).text_content()
+        except (etree.ParserError, ValueError):
+            # e.g. a body of only a comment or CDATA is an empty document
+            pass
+    return re.sub(r"<[^>]+>", " ", body)
+
+
+# Guards creating the per-server stores, several workers may ask at once
+STORES_LOCK = threading.Lock()
+INDEX = {}
+
+
+def get_space_index():
+    """
+    The shared SpaceIndex of the configured server, or None when disabled
+    or SQLite lacks FTS5.
+    """
+    settings = sublime.load_settings("Confluence.sublime-settings")
+    if not PAGE_STORE or not settings.get("space_index", True):
+        return None
+    path = server_cache_path("index")
+    with STORES_LOCK:
+        if path not in INDEX:
+            try:
+                INDEX[path] = SpaceIndex(path)
+            except sqlite3.OperationalError as e:
+                print("Confluence space index unavailable: {}".format(e))
+                INDEX[path] = False
+        return INDEX[path] or None
+
+
+def server_cache_path(name):
+    """
+    Path of the SQLite file name for the configured base_uri. Content ids
+    only mean something on their own server, so staging and production
+    with the same space keys get separate files.
+    """
+    settings = sublime.load_settings("Confluence.sublime-settings")
+    base_uri = (settings.get("base_uri") or "").rstrip("/")
+    server = hashlib.sha256(base_uri.encode("utf-8")).hexdigest()[:16]
+    return os.path.join(sublime.cache_path(), "Confluence", "{}-{}.sqlite".format(name, server))
+
+
+PAGES = {}
+
+
+def get_page_store():
+    """
+    The shared PageStore of the configured server, or None when disabled or
+    sqlite3 is unavailable.
+    """
+    settings = sublime.load_settings("Confluence.sublime-settings")
+    if not PAGE_STORE or not settings.get("page_store", True):
+        return None
+    path = server_cache_path("pages")
+    with STORES_LOCK:
+        if path not in PAGES:
+            PAGES[path] = PageStore(path)
+        return PAGES[path]
+
+
+def get_publish_manifest():
+    """
+    The page store when unchanged updates should be skipped, else None.
+    """
+    settings = sublime.load_settings("Confluence.sublime-settings")
+    return get_page_store() if settings.get("skip_unchanged_updates", True) else None
 
-    def delete_content(self, content_id):
-        return self._delete("content/{}".format(content_id))
 
+class ConfluenceClientRegistry(object):
+    """
+    Process-wide pool of ConfluenceApi clients keyed by (base_uri, username),
+    so commands share one long-lived session and its warm connection pool.
+    """
 
-class Markup(object):
     def __init__(self):
-        self.markups = dict([
-            ("Markdown", self.markdown_to_html),
-            ("Markdown Extended", self.markdown_to_html),
-            ("Markdown (Standard)", self.markdown_to_html),
-            ("reStructuredText", self.rst_to_html)])
+        self.lock = threading.Lock()
+        self.clients = dict()
+        self.configure(sublime.load_settings("Confluence.sublime-settings"))
+
+    def configure(self, settings):
+        self.reuse_session = settings.get("reuse_session", True)
+        self.pool_size = settings.get("connection_pool_size", 10)
+        self.idle_timeout = settings.get("session_idle_timeout", 300)
+        self.max_parallel_uploads = settings.get("max_parallel_uploads", 4)
+        self.timeout = settings.get("request_timeout", 60)
+        retry_budget = settings.get("retry_budget", 20)
+        self.retry_policy = RetryPolicy(
+            # A budget of 0 allows no retries at all, null any number of them
+            max_retries=settings.get("max_retries", 4) if retry_budget != 0 else 0,
+            backoff=settings.get("retry_backoff", 0.5),
+            backoff_max=settings.get("retry_backoff_max", 30),
+            deadline=settings.get("operation_deadline", 120),
+            budget=TokenBucket(retry_budget / 60.0, retry_budget) if retry_budget else None)
+        rate_limit = settings.get("rate_limit")
+        self.rate_limiter = TokenBucket(rate_limit, settings.get("rate_limit_burst", 10))
+        self.content_cache_size = settings.get("content_cache_size", 50)
+        self.compress_requests = settings.get("compress_requests", False)
+
+    def get(self, username, password, base_uri):
+        key = (base_uri, username)
+        now = time.time()
+        with self.lock:
+            self._evict_idle(now)
+            entry = self.clients.get(key)
+            if entry is None or entry[0].password != password:
+                if entry is not None:
+                    entry[0].close()
+                client = ConfluenceApi(username, password, base_uri,
+                                       reuse_session=self.reuse_session,
+                                       pool_size=self.pool_size,
+                                       max_parallel_uploads=self.max_parallel_uploads,
+                                       timeout=self.timeout,
+                                       retry_policy=self.retry_policy,
+                                       rate_limiter=self.rate_limiter,
+                                       content_cache_size=self.content_cache_size,
+                                       compress_requests=self.compress_requests)
+            else:
+                client = entry[0]
+            self.clients[key] = (client, now)
+            return client
+
+    def _evict_idle(self, now):
+        for key, (client, last_used) in list(self.clients.items()):
+            if now - last_used > self.idle_timeout:
+                client.close()
+                del self.clients[key]
+
+    def clear(self):
+        with self.lock:
+            for client, _ in self.clients.values():
+                client.close()
+            self.clients.clear()
+
+    def on_settings_change(self):
+        # Connection parameters may have changed, rebuild sessions lazily
+        settings = sublime.load_settings("Confluence.sublime-settings")
+        self.configure(settings)
+        self.clear()
+        SEARCHES.set_server(settings.get("base_uri"))
 
-    def markdown_to_html(self, content):
-        return markdown2.markdown(content).encode("utf-8").decode()
 
-    def rst_to_html(self, content):
-        try:
-            from docutils.core import publish_string
-            return publish_string(content, writer_name="html")
-        except ImportError:
-            error_msg = """
-            RstPreview requires docutils to be installed for the python interpreter that Sublime uses.
-            run: `sudo easy_install-2.6 docutils` and restart Sublime (if on Mac OS X or Linux).
-            For Windows check the docs at https://github.com/d0ugal/RstPreview
-            """
-            sublime.error_message(error_msg)
-            raise
-
-    def to_html(self, content, syntax):
-        syntax = syntax.split(".")[0].split("/")[-1]
-        if syntax not in self.markups:
-            sublime.error_message("Not support {} syntax yet".format(syntax))
+CLIENTS = None
+
+
+def get_clients():
+    global CLIENTS
+    if CLIENTS is None:
+        CLIENTS = ConfluenceClientRegistry()
+    return CLIENTS
+
+
+class OperationCancelled(Exception):
+    pass
+
+
+class ConfluenceTask(object):
+    """
+    A command operation running on the worker pool. Shows an animated
+    status-bar indicator on its view until it finishes and can be cancelled
+    between network steps.
+    """
+    STATUS_KEY = "confluence_task"
+    FRAMES = ["[=   ]", "[ =  ]", "[  = ]", "[   =]", "[  = ]", "[ =  ]"]
+
+    def __init__(self, view, label):
+        self.view = view
+        self.label = label
+        self.future = None
+        self.frame = 0
+        self.cancel_event = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def cancel(self):
+        self.cancel_event.set()
+        if self.future is not None:
+            self.future.cancel()
+
+    def check_cancelled(self):
+        if self.cancelled:
+            raise OperationCancelled(self.label)
+
+    def done(self):
+        return self.future is not None and self.future.done()
+
+    def report(self, message):
+        self.label = message
+
+    def upload_progress(self, filename, sent, total):
+        self.report("Uploading {} {}%".format(filename, 100 * sent // total if total else 100))
+
+    def show_progress(self):
+        if self.done():
+            self.view.erase_status(self.STATUS_KEY)
             return
-        else:
-            converter = self.markups[syntax]
-        new_content = converter(content)
-        if not new_content:
-            sublime.error_message(
-                "Can not parse this document.")
-        return new_content
-
-    def get_meta_and_content(self, contents):
-        meta = dict()
-        content = list()
-        tmp = contents.splitlines()
-        for x, entry in enumerate(tmp):
-            if entry.strip():
-                if re.match(r"[Ss]pace: *", entry):
-                    meta["space_key"] = re.sub("[^:]*: *", "", entry)
-                elif re.match(r"[Aa]ncestor Title: *", entry):
-                    meta["ancestor_title"] = re.sub("[^:]*: *", "", entry)
-                elif re.match(r"[Tt]itle: *", entry):
-                    meta["title"] = re.sub("[^:]*: *", "", entry)
-            else:
-                content = tmp[x + 1:]
+        self.view.set_status(self.STATUS_KEY, "Confluence: {} {}".format(
+            self.label, self.FRAMES[self.frame % len(self.FRAMES)]))
+        self.frame += 1
+        sublime.set_timeout(self.show_progress, 100)
+
+
+class CommandExecutor(object):
+    """
+    Bounded thread pool running the network and rendering part of the
+    commands off the UI thread.
+    """
+
+    def __init__(self, max_workers):
+        self.pool = ThreadPoolExecutor(max_workers=max_workers)
+        self.lock = threading.Lock()
+        self.tasks = []
+
+    def submit(self, view, label, fn, *args):
+        task = ConfluenceTask(view, label)
+        with self.lock:
+            self.tasks.append(task)
+        task.future = self.pool.submit(self._run, task, fn, *args)
+        # Also runs when the task is cancelled before it started
+        task.future.add_done_callback(lambda future: self._forget(task))
+        sublime.set_timeout(task.show_progress, 0)
+        return task
+
+    def _run(self, task, fn, *args):
+        # Retry waits of this operation end as soon as it is cancelled
+        confluence_core.set_retry_cancel_event(task.cancel_event)
+        try:
+            task.check_cancelled()
+            return fn(task, *args)
+        except OperationCancelled:
+            run_on_ui(sublime.status_message, "Confluence: {} cancelled".format(task.label))
+        except Exception as e:
+            traceback.print_exc()
+            run_on_ui(sublime.error_message, "Confluence: {} failed, reason: {}".format(
+                task.label, e))
+        finally:
+            confluence_core.set_retry_cancel_event(None)
+
+    def _forget(self, task):
+        with self.lock:
+            if task in self.tasks:
+                self.tasks.remove(task)
+
+    def cancel_all(self):
+        with self.lock:
+            tasks = list(self.tasks)
+        for task in tasks:
+            task.cancel()
+        return tasks
+
+    def shutdown(self):
+        self.cancel_all()
+        self.pool.shutdown(wait=False)
+
+
+def run_on_ui(fn, *args):
+    sublime.set_timeout(lambda: fn(*args), 0)
+
+
+EXECUTOR = None
+
+
+def get_executor():
+    global EXECUTOR
+    if EXECUTOR is None:
+        settings = sublime.load_settings("Confluence.sublime-settings")
+        EXECUTOR = CommandExecutor(settings.get("worker_threads", 4))
+    return EXECUTOR
+
+
+PREVIEW_RENDERER = None
+
+
+def get_preview_renderer():
+    """
+    Single thread rendering live previews, apart from the command workers
+    so a long publish doesn't hold up the preview.
+    """
+    global PREVIEW_RENDERER
+    if PREVIEW_RENDERER is None:
+        PREVIEW_RENDERER = ThreadPoolExecutor(max_workers=1)
+    return PREVIEW_RENDERER
+
+
+def warm_up():
+    """
+    Pay the first-command costs in the background: heavy imports, the
+    pooled authenticated session, and the default space's page titles
+    (provisional search results) with their ids (resolution index, used
+    for ancestors).
+    """
+    started = time.time()
+    try:
+        import docutils.core  # noqa: F401
+    except ImportError:
+        pass
+    Markup().markdown_to_html("warm *up*")
+    settings = sublime.load_settings("Confluence.sublime-settings")
+    username = settings.get("username")
+    password = settings.get("password")
+    base_uri = settings.get("base_uri")
+    space_key = settings.get("default_space_key")
+    if not (username and password and base_uri):
+        return
+    confluence_api = get_clients().get(username, password, base_uri)
+    try:
+        confluence_api.authenticate()
+    except requests.RequestException as e:
+        print("Confluence warm-up: can not connect, reason: {}".format(e))
+        return
+    if space_key:
+        store = get_page_store()
+        max_results = settings.get("search_max_results", 500)
+        pages = []
+        cql = "type=page AND space=\"{}\"".format(space_key)
+        for response in confluence_api.iter_cql(cql, limit=100, expand="version"):
+            if not response.ok:
+                print("Confluence warm-up: can not list pages of {}, reason: {}".format(
+                    space_key, response.reason))
+                return
+            results = response.json()["results"]
+            pages.extend(dict(id=page["id"], title=page["title"]) for page in results)
+            if store:
+                store.remember_many((space_key, page["title"], page["id"], page["version"]["number"])
+                                    for page in results)
+            if len(pages) >= max_results:
                 break
-        return (meta, content)
+        # Never complete: narrowed by title it only stands in for server
+        # searches. Kept past the ttl, the first search comes minutes later
+        SEARCHES.put(space_key, "", pages[:max_results], False, expire=False)
+    print("Confluence warm-up done in {:.1f}s".format(time.time() - started))
+
+
+class Markup(confluence_core.Markup):
+    def __init__(self):
+        settings = sublime.load_settings("Confluence.sublime-settings")
+        super(Markup, self).__init__(extras=settings.get("markdown_extras"))
+
+    def report_error(self, message):
+        sublime.error_message(message)
+
+
+# Shows the client's diagnostics in the Sublime console
+LOG_HANDLER = logging.StreamHandler(sys.stdout)
+
+
+def plugin_loaded():
+    confluence_core.logger.addHandler(LOG_HANDLER)
+    confluence_core.logger.setLevel(logging.INFO)
+    confluence_core.logger.propagate = False
+    settings = sublime.load_settings("Confluence.sublime-settings")
+    settings.add_on_change("confluence_clients", lambda: get_clients().on_settings_change())
+    SEARCHES.set_server(settings.get("base_uri"))
+    if settings.get("warm_up", False):
+        threading.Thread(target=warm_up, name="ConfluenceWarmUp", daemon=True).start()
+
+
+def plugin_unloaded():
+    confluence_core.logger.removeHandler(LOG_HANDLER)
+    sublime.load_settings("Confluence.sublime-settings").clear_on_change("confluence_clients")
+    if EXECUTOR is not None:
+        EXECUTOR.shutdown()
+    if PREVIEW_RENDERER is not None:
+        PREVIEW_RENDERER.shutdown(wait=False)
+    if CLIENTS is not None:
+        CLIENTS.clear()
 
 
 class BaseConfluencePageCommand(sublime_plugin.TextCommand):
@@ -283,6 +583,34 @@ class BaseConfluencePageCommand(sublime_plugin.TextCommand):
         self.password = settings.get("password") if settings.get("password") else ""
         self.default_space_key = settings.get("default_space_key")
 
+    def get_client(self):
+        return get_clients().get(self.username, self.password, self.base_uri)
+
+    def resolve_titles(self, pairs):
+        """
+        Map (space_key, title) pairs to (id, version) through the resolution
+        index, looking up every miss with one batched search. Pages that do
+        not exist are left out; returns None after reporting a failed lookup.
+        """
+        resolved, response = self.get_client().resolve_titles(pairs, get_page_store())
+        if response is not None and not response.ok:
+            print(response.text)
+            run_on_ui(self.on_failed, "Can not get content by title, reason: {}".format(response.reason))
+            return None
+        return resolved
+
+    def run_in_background(self, label, fn, *args):
+        """
+        Run fn(task, *args) on the worker pool, fn hands view and clipboard
+        updates back to the UI thread through run_on_ui.
+        """
+        return get_executor().submit(self.view, label, fn, *args)
+
+    def on_failed(self, message, *debug_contents):
+        for header, debug_content in debug_contents:
+            debug_tab(self, debug_content, header)
+        sublime.error_message(message)
+
     def get_credential(self):
         if not self.username and not self.password:
             sublime.status_message("Waiting for username")
@@ -370,47 +698,57 @@ class PostConfluencePageCommand(BaseConfluencePageCommand):
     def post(self):
         region = sublime.Region(0, self.view.size())
         contents = self.view.substr(region)
+        syntax = self.view.settings().get("syntax")
+        self.run_in_background("Posting page", self.post_async,
+                               contents, syntax, self.view.file_name())
+
+    def post_async(self, task, contents, syntax, filename):
         markup = Markup()
         meta, content = markup.get_meta_and_content(contents)
-        syntax = self.view.settings().get("syntax")
         new_content = markup.to_html("\n".join(content), syntax)
         if not new_content:
             return
-        self.confluence_api = ConfluenceApi(self.username, self.password, self.base_uri)
-        response = self.confluence_api.get_content_by_title(
-            meta["space_key"], meta["ancestor_title"])
-        if response.ok:
-            ancestor = response.json()["results"][0]
-            ancestor_id = int(ancestor["id"])
-            space = dict(key=meta["space_key"])
-            body = dict(storage=dict(value=new_content, representation="storage"))
-            data = dict(type="page", title=meta["title"], ancestors=[dict(id=ancestor_id)],
-                        space=space, body=body)
-            result, mod_content = self.confluence_api.create_content(data, self.view.file_name())
-            if result.ok:
-                self.view.settings().set("confluence_content", result.json())
-                # copy content url
-                content_uri = self.confluence_api.get_content_uri(result.json())
-                sublime.set_clipboard(content_uri)
-                sublime.status_message(self.MSG_SUCCESS)
-            else:
-                print(result.text)
-
-                debug_tab(self, new_content, "Source")
-                debug_tab(self, mod_content, "Modified")
-
-                sublime.error_message("Can not create content, reason: {}".format(result.reason))
+        self.confluence_api = self.get_client()
+        store = get_page_store()
+        ancestor = (meta["space_key"], meta["ancestor_title"])
+        # The page itself is looked up in the same request to warm the index
+        resolved = self.resolve_titles([ancestor, (meta["space_key"], meta["title"])])
+        if resolved is None:
+            return
+        if ancestor not in resolved:
+            run_on_ui(self.on_failed, "Can not find ancestor {} in space {}".format(
+                meta["ancestor_title"], meta["space_key"]), ("Source", new_content))
+            return
+        ancestor_id = int(resolved[ancestor][0])
+        space = dict(key=meta["space_key"])
+        body = dict(storage=dict(value=new_content, representation="storage"))
+        data = dict(type="page", title=meta["title"], ancestors=[dict(id=ancestor_id)],
+                    space=space, body=body)
+        task.check_cancelled()
+        result, mod_content = self.confluence_api.create_content(
+            data, filename, progress=task.upload_progress, store=get_publish_manifest())
+        if result.ok:
+            if store:
+                store.remember(meta["space_key"], meta["title"], result.json()["id"],
+                               result.json()["version"]["number"])
+            run_on_ui(self.on_posted, result.json())
         else:
-            print(response.text)
-
-            debug_tab(self, new_content, "Source")
+            print(result.text)
+            run_on_ui(self.on_failed, "Can not create content, reason: {}".format(result.reason),
+                      ("Source", new_content), ("Modified", mod_content))
 
-            sublime.error_message("Can not get ancestor, reason: {}".format(response.reason))
+    def on_posted(self, content):
+        self.view.settings().set("confluence_content", content)
+        # copy content url
+        content_uri = self.confluence_api.get_content_uri(content)
+        sublime.set_clipboard(content_uri)
+        sublime.status_message(self.MSG_SUCCESS)
 
 
 class GetConfluencePageCommand(BaseConfluencePageCommand):
     MSG_SPACE_KEY = "Confluence space key:"
     MSG_SEARCH_PAGE = "Page title:"
+    MSG_MORE_PAGES = "More results..."
     MSG_SUCCESS = "Content url copied to the clipboard."
     all_space = False
     specific_space_key = False
@@ -439,78 +777,234 @@ class GetConfluencePageCommand(BaseConfluencePageCommand):
 
     def get_page_title(self):
         sublime.status_message("Waiting for page title")
+        settings = sublime.load_settings("Confluence.sublime-settings")
+        self.typed_generation = 0
+        self.typing_task = None
+        on_change = self.on_change_page_title if settings.get("incremental_search", True) else None
         self.view.window().show_input_panel(
-            self.MSG_SEARCH_PAGE, "", self.on_done_page_title, None, None)
+            self.MSG_SEARCH_PAGE, "", self.on_done_page_title, on_change, None)
 
     def on_done_space_key(self, value):
         self.space_key = value
         sublime.set_timeout(self.get_page_title, 50)
 
+    def on_change_page_title(self, value):
+        self.typed_generation += 1
+        if len(value.strip()) < 3:
+            return
+        cached = SEARCHES.get(self.space_key, value)
+        if cached is not None:
+            sublime.status_message("{} page(s) match \"{}\"".format(len(cached[0]), value))
+            return
+        narrowed = SEARCHES.narrow(self.space_key, value)
+        if narrowed is not None:
+            # Shown while the server is asked, which may find more
+            sublime.status_message("{} page(s) match \"{}\" so far".format(len(narrowed), value))
+        generation = self.typed_generation
+        settings = sublime.load_settings("Confluence.sublime-settings")
+        sublime.set_timeout(lambda: self.search_as_you_type(generation, value),
+                            settings.get("incremental_search_delay", 300))
+
+    def search_as_you_type(self, generation, value):
+        if generation != self.typed_generation:
+            # Superseded by a later keystroke while waiting
+            return
+        if self.typing_task is not None:
+            self.typing_task.cancel()
+        self.typing_task = self.run_in_background("Searching pages", self.prefetch_pages,
+                                                  generation, value)
+
+    def prefetch_pages(self, task, generation, value):
+        settings = sublime.load_settings("Confluence.sublime-settings")
+        page_size = settings.get("search_page_size", 25)
+        confluence_api = self.get_client()
+        response = confluence_api.search_content(self.space_key, value, limit=page_size)
+        if not response.ok:
+            return
+        search_result = response.json()
+        SEARCHES.put(self.space_key, value, search_result["results"],
+                     not confluence_api.has_next_page(search_result, page_size))
+        if generation == self.typed_generation:
+            run_on_ui(sublime.status_message, "{} page(s) match \"{}\"".format(
+                len(search_result["results"]), value))
+
     def on_done_page_title(self, value):
         self.page_title = value
-        sublime.set_timeout(self.get_pages, 50)
-
-    def get_pages(self):
-        self.confluence_api = ConfluenceApi(self.username, self.password, self.base_uri)
-        response = self.confluence_api.search_content(self.space_key, self.page_title)
+        self.picked = False
+        self.has_more = False
+        self.pages = []
+        if getattr(self, "typing_task", None) is not None:
+            self.typing_task.cancel()
+        self.confluence_api = self.get_client()
+        settings = sublime.load_settings("Confluence.sublime-settings")
+        self.page_size = settings.get("search_page_size", 25)
+        self.max_results = settings.get("search_max_results", 500)
+        index = get_space_index()
+        if index and index.synced_at(self.space_key):
+            # The space is indexed locally, search titles and bodies offline
+            self.found = index.search(self.space_key, self.page_title, self.max_results)
+            if self.found:
+                self.show_pages(list(self.found))
+                return
+        cached = SEARCHES.get(self.space_key, self.page_title)
+        if cached is not None:
+            # Searched while typing, only remaining result pages need the server
+            pages, complete = cached
+            self.found = list(pages[:self.max_results])
+            self.has_more = not complete and len(self.found) < self.max_results
+            self.search = self.confluence_api.iter_search_content(
+                self.space_key, self.page_title, self.page_size, start=len(self.found))
+            self.show_pages(list(self.found))
+            return
+        # Offer narrowed results of a shorter query, or else pages fetched
+        # before, while the server is queried
+        self.pages = SEARCHES.narrow(self.space_key, self.page_title) or []
+        store = get_page_store()
+        if not self.pages and store:
+            self.pages = store.search(self.space_key, self.page_title)
+        if self.pages:
+            self.view.window().show_quick_panel(
+                [page["title"] for page in self.pages], self.on_done_pages)
+        self.run_in_background("Searching pages", self.get_pages)
+
+    def get_pages(self, task):
+        self.found = []
+        self.search = self.confluence_api.iter_search_content(
+            self.space_key, self.page_title, self.page_size)
+        self.get_more_pages(task)
+
+    def get_more_pages(self, task):
+        response = next(self.search)
         if response.ok:
-            self.pages = response.json()["results"]
-            packed_pages = [page["title"] for page in self.pages]
-            if packed_pages:
-                self.view.window().show_quick_panel(packed_pages, self.on_done_pages)
-            else:
-                sublime.error_message("No result found for {}".format(self.page_title))
+            search_result = response.json()
+            self.found.extend(search_result["results"][:self.max_results - len(self.found)])
+            self.has_more = (len(self.found) < self.max_results and
+                             self.confluence_api.has_next_page(search_result, self.page_size))
+            run_on_ui(self.show_pages, list(self.found), len(self.found) - len(search_result["results"]))
         else:
             print(response.text)
-            sublime.error_message("Can not get pages, reason: {}".format(response.reason))
+            if not self.pages:
+                run_on_ui(sublime.error_message, "Can not get pages, reason: {}".format(response.reason))
+
+    def show_pages(self, pages, selected_index=0):
+        if self.picked:
+            return
+        if pages and [page["id"] for page in pages] == [page["id"] for page in self.pages] and \
+                not self.has_more:
+            return
+        self.pages = pages
+        packed_pages = [page["title"] for page in self.pages]
+        if packed_pages:
+            if self.has_more:
+                packed_pages.append(self.MSG_MORE_PAGES)
+            self.view.window().show_quick_panel(packed_pages, self.on_done_pages, 0, max(0, selected_index))
+        else:
+            sublime.error_message("No result found for {}".format(self.page_title))
 
     def on_done_pages(self, idx):
         if idx == -1:
             return
+        if idx == len(self.pages):
+            self.run_in_background("Loading more pages", self.get_more_pages)
+            return
+        self.picked = True
         content_id = self.pages[idx]["id"]
+        self.run_in_background("Fetching page", self.get_page, content_id)
+
+    def prettify(self, body):
+        if HTML_PRETTIFY:
+            document_root = lxml.html.fromstring(body)
+            body = (lxml.etree.tostring(document_root, encoding="unicode", pretty_print=True))
+        return body
+
+    def get_page(self, task, content_id):
+        self.confluence_api = self.get_client()
+        store = get_page_store()
+        stored = store.get(content_id) if store else None
+        if stored:
+            # Serve the local copy now, replace it below if the server has a newer version
+            page_view = []
+            run_on_ui(lambda: page_view.append(
+                self.show_page(stored, self.prettify(stored["body"]["storage"]["value"]))))
+            task.report("Refreshing page")
         response = self.confluence_api.get_content_by_id(content_id)
         if response.ok:
             content = response.json()
-            body = content["body"]["storage"]["value"]
-            if HTML_PRETTIFY:
-                document_root = lxml.html.fromstring(body)
-                body = (lxml.etree.tostring(document_root, encoding="unicode", pretty_print=True))
-
-            new_view = self.view.window().new_file()
-            # set syntax file
-            new_view.set_syntax_file("Packages/HTML/HTML.sublime-syntax")
-            new_view.settings().set("auto_indent", False)
-
-            # insert the page
-            new_view.run_command("insert", {"characters": body})
-            new_view.set_name(content["title"])
-            new_view.settings().set("confluence_content", content)
-            new_view.settings().set("auto_indent", True)
-            new_view.run_command("reindent", {"single_line": False})
-            new_view.run_command("expand_tabs", {"set_translate_tabs": True})
-
-            # copy content url
-            content_uri = self.confluence_api.get_content_uri(content)
-            sublime.set_clipboard(content_uri)
-            sublime.status_message(self.MSG_SUCCESS)
+            if store:
+                store.put(content)
+            if stored and stored["version"]["number"] == content["version"]["number"]:
+                return
+            body = self.prettify(content["body"]["storage"]["value"])
+            if stored:
+                run_on_ui(lambda: self.refresh_page(page_view[0], content, body))
+            else:
+                run_on_ui(self.show_page, content, body)
         else:
             print(response.text)
-            sublime.error_message("Can not get content, reason: {}".format(response.reason))
+            run_on_ui(sublime.error_message, "Can not get content, reason: {}".format(response.reason))
+
+    def fill_page_view(self, page_view, content, body):
+        page_view.settings().set("auto_indent", False)
+
+        # insert the page
+        page_view.run_command("select_all")
+        page_view.run_command("insert", {"characters": body})
+        page_view.set_name(content["title"])
+        page_view.settings().set("confluence_content", content)
+        page_view.settings().set("auto_indent", True)
+        page_view.run_command("reindent", {"single_line": False})
+        page_view.run_command("expand_tabs", {"set_translate_tabs": True})
+        # Lets refresh_page tell whether the user edited the page since
+        page_view.settings().set("confluence_change_count", page_view.change_count())
+
+    def show_page(self, content, body):
+        new_view = self.view.window().new_file()
+        # set syntax file
+        new_view.set_syntax_file("Packages/HTML/HTML.sublime-syntax")
+        self.fill_page_view(new_view, content, body)
+
+        # copy content url
+        content_uri = self.confluence_api.get_content_uri(content)
+        sublime.set_clipboard(content_uri)
+        sublime.status_message(self.MSG_SUCCESS)
+        return new_view
+
+    def refresh_page(self, page_view, content, body):
+        if not page_view.is_valid():
+            return
+        if page_view.change_count() != page_view.settings().get("confluence_change_count"):
+            # Keep the user's edits, an update will report the version conflict
+            sublime.status_message("Version {} of {} is on the server, view not refreshed "
+                                   "because it was edited".format(content["version"]["number"],
+                                                                  content["title"]))
+            return
+        self.fill_page_view(page_view, content, body)
+        sublime.status_message("Page refreshed to version {}".format(content["version"]["number"]))
 
 
 class UpdateConfluencePageCommand(BaseConfluencePageCommand):
     MSG_SUCCESS = "Page updated and url copied to the clipboard."
+    MSG_UNCHANGED = "Page unchanged, update not sent; url copied to the clipboard."
 
-    def run(self, edit):
+    def run(self, edit, dry_run=False):
         super(UpdateConfluencePageCommand, self).run(edit)
-        self.content = self.view.settings().get("confluence_content")
-        if self.content and self.content.get('id'):
-            self.callback = self.update_from_editor
+        # The instance is shared by every run in this view, hand each run its
+        # own flag and page to the worker instead of reading attributes there
+        content = self.view.settings().get("confluence_content")
+        if content and content.get('id'):
+            self.callback = lambda: self.update_from_editor(dry_run, content)
         else:
-            self.callback = self.update_from_source
+            self.callback = lambda: self.update_from_source(dry_run)
         sublime.set_timeout(self.get_credential, 50)
 
-    def update_from_editor(self):
+    def update_from_editor(self, dry_run, content):
+        region = sublime.Region(0, self.view.size())
+        contents = self.view.substr(region)
+        syntax = self.view.settings().get("syntax")
+        self.run_in_background("Updating page", self.update_from_editor_async,
+                               contents, syntax, self.view.file_name(), dry_run, content)
+
+    def update_from_editor_async(self, task, contents, syntax, filename, dry_run, page):
         # Example Data:
         """
         {
@@ -531,13 +1025,10 @@ class UpdateConfluencePageCommand(BaseConfluencePageCommand):
           }
         }
         """
-        content_id = self.content["id"]
-        title = self.content["title"]
-        space_key = self.content["space"]["key"]
-        version_number = self.content["version"]["number"] + 1
-        region = sublime.Region(0, self.view.size())
-        contents = self.view.substr(region)
-        syntax = self.view.settings().get("syntax")
+        content_id = page["id"]
+        title = page["title"]
+        space_key = page["space"]["key"]
+        version_number = page["version"]["number"] + 1
         if "HTML" in syntax:
             new_content = "".join(contents.split("\n"))
         else:
@@ -549,94 +1040,161 @@ class UpdateConfluencePageCommand(BaseConfluencePageCommand):
         body = dict(storage=dict(value=new_content, representation="storage"))
         data = dict(id=content_id, type="page", title=title,
                     space=space, version=version, body=body)
-        try:
-            self.confluence_api = ConfluenceApi(self.username, self.password, self.base_uri)
-            response, mod_content = self.confluence_api.update_content(content_id,
-                                                                       data,
-                                                                       self.view.file_name())
-
-            if response.ok:
-                content_uri = self.confluence_api.get_content_uri(self.content)
-                sublime.set_clipboard(content_uri)
-
-                debug_tab(self, mod_content, "Modified")
-
-                sublime.status_message(self.MSG_SUCCESS)
-                self.view.settings().set("confluence_content", response.json())
-            else:
-                print(response.text)
-
-                debug_tab(self, mod_content, "Modified")
+        self.confluence_api = self.get_client()
+        if dry_run:
+            self.preview_update(content_id, version_number - 1, data, filename)
+            return
+        threshold = self.minor_edit_threshold()
+        previous_body = self.previous_body(content_id, version_number - 1, page) \
+            if threshold is not None else None
+        response, mod_content = self.confluence_api.update_content(
+            content_id, data, filename, progress=task.upload_progress, store=get_publish_manifest(),
+            previous_body=previous_body, minor_edit_threshold=threshold)
 
-                sublime.error_message("Can't update content, reason: {}".format(response.reason))
-        except Exception:
+        if response.ok:
+            store = get_page_store()
+            if store:
+                store.remember(space_key, title, content_id, response.json()["version"]["number"])
+            content_uri = self.confluence_api.get_content_uri(page)
+            run_on_ui(self.on_updated, response, content_uri, ("Modified", mod_content))
+        else:
             print(response.text)
+            run_on_ui(self.on_failed, "Can't update content, reason: {}".format(response.reason),
+                      ("Modified", mod_content))
 
-            debug_tab(self, mod_content, "Modified")
-
-            sublime.error_message("Can't update content, reason: {}".format(response.reason))
-
-    def update_from_source(self):
-
-        current_filename = self.view.file_name()
+    def update_from_source(self, dry_run):
         region = sublime.Region(0, self.view.size())
         contents = self.view.substr(region)
+        syntax = self.view.settings().get("syntax")
+        self.run_in_background("Updating page", self.update_from_source_async,
+                               contents, syntax, self.view.file_name(), dry_run)
+
+    def update_from_source_async(self, task, contents, syntax, current_filename, dry_run):
         markup = Markup()
         meta, content = markup.get_meta_and_content(contents)
-        syntax = self.view.settings().get("syntax")
         new_content = markup.to_html("\n".join(content), syntax)
         if not new_content:
-            sublime.error_message(
-                "Can't update: this doesn't appear to be a valid Confluence page.")
+            run_on_ui(sublime.error_message,
+                      "Can't update: this doesn't appear to be a valid Confluence page.")
             return
-        self.confluence_api = ConfluenceApi(self.username, self.password, self.base_uri)
-
-        get_content_by_title_resp = self.confluence_api.get_content_by_title(
-            meta["space_key"], meta["title"])
-        if get_content_by_title_resp.ok:
-            content_id = get_content_by_title_resp.json()["results"][0]["id"]
-
-            get_content_by_id_resp = self.confluence_api.get_content_by_id(content_id)
-            if get_content_by_id_resp.ok:
-                content = get_content_by_id_resp.json()
-                space = dict(key=meta["space_key"])
-                version_number = content["version"]["number"] + 1
-                version = dict(number=version_number, minorEdit=False)
-                # ancestor_id = int(ancestor["id"])
-                body = dict(storage=dict(value=new_content, representation="storage"))
-                data = dict(id=content_id, type="page", title=meta["title"],
-                            space=space, version=version, body=body)
-
-                update_content_resp, mod_content = self.confluence_api.update_content(content_id,
-                                                                                      data,
-                                                                                      current_filename)
-
-                if update_content_resp.ok:
-                    self.view.settings().set("confluence_content", update_content_resp.json())
-                    content_uri = self.confluence_api.get_content_uri(update_content_resp.json())
-
-                    sublime.set_clipboard(content_uri)
-                    sublime.status_message(self.MSG_SUCCESS)
-                else:
-                    print(update_content_resp.text)
-
-                    debug_tab(self, new_content, "Source")
-                    debug_tab(self, mod_content, "Modified")
-
-                    sublime.error_message("Can not update content, reason: {}".format(
-                        update_content_resp.reason))
-            else:
-                print(get_content_by_id_resp.text)
+        self.confluence_api = self.get_client()
+        store = get_page_store()
+        space_key = meta["space_key"]
+        title = meta["title"]
 
-                debug_tab(self, new_content, "Source")
-
-                sublime.error_message("Can not get content by id, reason: {}".format(
-                    get_content_by_id_resp.reason))
+        resolved = self.resolve_page(space_key, title)
+        if resolved is None:
+            return
+        if dry_run:
+            content_id, version_number = resolved
+            body = dict(storage=dict(value=new_content, representation="storage"))
+            data = dict(id=content_id, type="page", title=title, space=dict(key=space_key),
+                        version=dict(number=version_number + 1, minorEdit=False), body=body)
+            self.preview_update(content_id, version_number, data, current_filename)
+            return
+        threshold = self.minor_edit_threshold()
+        for attempt in range(2):
+            content_id, version_number = resolved
+            space = dict(key=space_key)
+            version = dict(number=version_number + 1, minorEdit=False)
+            # ancestor_id = int(ancestor["id"])
+            body = dict(storage=dict(value=new_content, representation="storage"))
+            data = dict(id=content_id, type="page", title=title,
+                        space=space, version=version, body=body)
+
+            task.check_cancelled()
+            previous_body = self.previous_body(content_id, version_number) \
+                if threshold is not None else None
+            update_content_resp, mod_content = self.confluence_api.update_content(
+                content_id, data, current_filename, progress=task.upload_progress,
+                store=get_publish_manifest(), previous_body=previous_body,
+                minor_edit_threshold=threshold)
+            if update_content_resp.status_code not in self.confluence_api.STALE_TARGET_CODES or attempt:
+                break
+            # The indexed page is stale: deleted, saved or renamed on the server meanwhile
+            resolved, response = self.confluence_api.refresh_resolution(space_key, title, store)
+            if not response.ok:
+                print(response.text)
+                run_on_ui(self.on_failed, "Can not get content by title, reason: {}".format(response.reason))
+                return
+            if resolved is None:
+                run_on_ui(sublime.error_message, "Can not find page {} in space {}".format(title, space_key))
+                return
+
+        if update_content_resp.ok:
+            if store:
+                store.remember(space_key, title, content_id,
+                               update_content_resp.json()["version"]["number"])
+            content_uri = self.confluence_api.get_content_uri(update_content_resp.json())
+            run_on_ui(self.on_updated, update_content_resp, content_uri)
         else:
-            print(get_content_by_title_resp.text)
+            print(update_content_resp.text)
+            run_on_ui(self.on_failed, "Can not update content, reason: {}".format(
+                update_content_resp.reason), ("Source", new_content), ("Modified", mod_content))
+
+    def resolve_page(self, space_key, title):
+        resolved = self.resolve_titles([(space_key, title)])
+        if resolved is None:
+            return None
+        if (space_key, title) not in resolved:
+            run_on_ui(sublime.error_message, "Can not find page {} in space {}".format(title, space_key))
+            return None
+        return resolved[(space_key, title)]
+
+    def minor_edit_threshold(self):
+        settings = sublime.load_settings("Confluence.sublime-settings")
+        return settings.get("minor_edit_threshold")
 
-            sublime.error_message("Can not get content by title, reason: {}".format(
-                get_content_by_title_resp.reason))
+    def previous_body(self, content_id, version_number, *known):
+        """
+        Return the storage body of the version being replaced when a copy of
+        it is at hand: in the view, the content cache or the page store.
+        """
+        candidates = list(known) + [self.confluence_api.cached_content(content_id, version_number)]
+        store = get_page_store()
+        if store:
+            published = store.last_published(content_id)
+            candidates.extend([published and published["content"], store.get(content_id)])
+        for content in candidates:
+            if content and content["version"]["number"] == version_number and \
+                    "storage" in content.get("body", {}):
+                return content["body"]["storage"]["value"]
+        return None
+
+    def preview_update(self, content_id, version_number, data, filename):
+        response = self.confluence_api.get_content_by_id(content_id)
+        if not response.ok:
+            print(response.text)
+            run_on_ui(sublime.error_message, "Can not get content, reason: {}".format(response.reason))
+            return
+        current = response.json()
+        new_content_data, images = self.confluence_api.extract_images(data, source_filename=filename)
+        diff = StorageDiff(current["body"]["storage"]["value"],
+                           new_content_data["body"]["storage"]["value"])
+        threshold = self.minor_edit_threshold()
+        lines = ["Dry run: update of \"{}\" (version {})".format(
+            current["title"], current["version"]["number"])]
+        if current["version"]["number"] != version_number:
+            lines.append("Warning: the page changed on the server since version {}".format(version_number))
+        if diff.changed() and threshold is not None:
+            lines.append("Would be saved as a {} edit".format(
+                "minor" if diff.is_minor(threshold) else "major"))
+        lines.append("")
+        run_on_ui(self.show_diff, "\n".join(lines) + diff.format())
+
+    def show_diff(self, text):
+        window = self.view.window()
+        panel = window.create_output_panel("confluence_diff")
+        panel.set_syntax_file("Packages/Diff/Diff.sublime-syntax")
+        panel.run_command("append", {"characters": text})
+        window.run_command("show_panel", {"panel": "output.confluence_diff"})
+
+    def on_updated(self, response, content_uri, *debug_contents):
+        sublime.set_clipboard(content_uri)
+        for header, debug_content in debug_contents:
+            debug_tab(self, debug_content, header)
+        sublime.status_message(self.MSG_UNCHANGED if isinstance(response, UnchangedPage) else self.MSG_SUCCESS)
+        self.view.settings().set("confluence_content", response.json())
 
 
 class DeleteConfluencePageCommand(BaseConfluencePageCommand):
@@ -653,15 +1211,273 @@ class DeleteConfluencePageCommand(BaseConfluencePageCommand):
         sublime.set_timeout(self.get_credential, 50)
 
     def delete(self):
-        content_id = str(self.content["id"])
-        try:
-            self.confluence_api = ConfluenceApi(self.username, self.password, self.base_uri)
-            response = self.confluence_api.delete_content(content_id)
-            if response.ok:
-                sublime.status_message(self.MSG_SUCCESS)
-            else:
+        self.run_in_background("Deleting page", self.delete_async, str(self.content["id"]))
+
+    def delete_async(self, task, content_id):
+        self.confluence_api = self.get_client()
+        response = self.confluence_api.delete_content(content_id)
+        if response.ok:
+            store = get_page_store()
+            if store:
+                store.delete(content_id)
+            run_on_ui(sublime.status_message, self.MSG_SUCCESS)
+        else:
+            print(response.text)
+            run_on_ui(sublime.error_message, "Can't delete content, reason: {}".format(response.reason))
+
+
+class PublishConfluenceFolderCommand(BaseConfluencePageCommand):
+    """
+    Publish every Markdown/reStructuredText file below a folder. Pages run
+    concurrently, a page whose ancestor is another file of the folder is
+    published after it.
+    """
+    MSG_FOLDER = "Folder to publish:"
+
+    def run(self, edit, folder=None):
+        super(PublishConfluenceFolderCommand, self).run(edit)
+        self.folder = folder
+        self.callback = self.get_folder
+        sublime.set_timeout(self.get_credential, 50)
+
+    def get_folder(self):
+        if self.folder:
+            self.on_done_folder(self.folder)
+            return
+        folders = self.view.window().folders()
+        initial = os.path.dirname(self.view.file_name()) if self.view.file_name() else \
+            (folders[0] if folders else "")
+        self.view.window().show_input_panel(self.MSG_FOLDER, initial, self.on_done_folder, None, None)
+
+    def on_done_folder(self, value):
+        self.run_in_background("Publishing {}".format(os.path.basename(value)), self.publish, value)
+
+    def publish(self, task, folder):
+        started = time.time()
+        settings = sublime.load_settings("Confluence.sublime-settings")
+        # The core Markup logs render errors, they are in the report too
+        # and a dialog per failed file would pile up from the workers
+        markup = confluence_core.Markup(extras=settings.get("markdown_extras"))
+        publisher = FolderPublisher(self.get_client(), markup,
+                                    workers=settings.get("bulk_publish_workers", 4),
+                                    store=get_page_store(), progress=task.report,
+                                    cancelled=lambda: task.cancelled,
+                                    skip_unchanged=settings.get("skip_unchanged_updates", True))
+        results = publisher.publish([folder])
+        run_on_ui(self.show_report, folder, results, time.time() - started)
+
+    def show_report(self, folder, results, seconds):
+        failed = [result for result in results if not result["ok"]]
+        skipped = [result for result in results if result["ok"] and result["action"] == "skipped"]
+        lines = ["Published {} in {:.1f}s: {} page(s), {} skipped, {} failed".format(
+            folder, seconds, len(results) - len(skipped), len(skipped), len(failed)), ""]
+        for result in sorted(results, key=lambda result: result["path"]):
+            lines.append("{:<6} {:<8} {:>7.2f}s  {}{}".format(
+                "OK" if result["ok"] else "FAILED", result.get("action", ""), result["seconds"],
+                os.path.relpath(result["path"], folder),
+                "  ({})".format(result.get("reason"))
+                if not result["ok"] or result["action"] == "skipped" else ""))
+        report_view = self.view.window().new_file()
+        report_view.set_name("Confluence publish report")
+        report_view.set_scratch(True)
+        report_view.run_command("insert", {"characters": "\n".join(lines) + "\n"})
+        sublime.status_message(lines[0])
+
+
+class SyncConfluenceSpaceIndexCommand(BaseConfluencePageCommand):
+    """
+    Download titles and bodies of a space into the local full-text index,
+    only pages modified since the last sync unless full is set. An
+    incremental sync also lists the ids of the space to drop deleted and
+    moved pages.
+    """
+    MSG_SPACE_KEY = "Confluence space key to index:"
+    # Modification times are compared by date on the server, re-read a day
+    # more than needed to be safe against time zone differences
+    SYNC_OVERLAP = 24 * 60 * 60
+
+    def run(self, edit, full=False):
+        super(SyncConfluenceSpaceIndexCommand, self).run(edit)
+        # The instance is shared by every run in this view, hand the flag on
+        # to the worker instead of reading an attribute there
+        self.callback = lambda: self.get_space_key(full)
+        sublime.set_timeout(self.get_credential, 50)
+
+    def get_space_key(self, full):
+        if get_space_index() is None:
+            sublime.error_message("Confluence space index needs SQLite with FTS5 support.")
+            return
+        self.view.window().show_input_panel(
+            self.MSG_SPACE_KEY, self.default_space_key or "",
+            lambda value: self.on_done_space_key(value, full), None, None)
+
+    def on_done_space_key(self, value, full):
+        self.run_in_background("Indexing {}".format(value), self.sync, value, full)
+
+    def sync(self, task, space_key, full):
+        index = get_space_index()
+        confluence_api = self.get_client()
+        started = time.time()
+        synced_at = None if full else index.synced_at(space_key)
+        cql = "type=page AND space=\"{}\"".format(space_key)
+        if synced_at:
+            cql += " AND lastmodified >= \"{}\"".format(
+                time.strftime("%Y-%m-%d", time.gmtime(synced_at - self.SYNC_OVERLAP)))
+        else:
+            index.clear(space_key)
+        count = 0
+        for response in confluence_api.iter_cql(cql, limit=50, expand="body.storage"):
+            task.check_cancelled()
+            if not response.ok:
                 print(response.text)
-                sublime.error_message("Can't delete content, reason: {}".format(response.reason))
+                run_on_ui(sublime.error_message, "Can not index space {}, reason: {}".format(
+                    space_key, response.reason))
+                return
+            pages = response.json()["results"]
+            index.add_pages(space_key, pages)
+            count += len(pages)
+            task.report("Indexing {}: {} pages".format(space_key, count))
+        removed = 0
+        if synced_at:
+            current = set()
+            cql = "type=page AND space=\"{}\"".format(space_key)
+            for response in confluence_api.iter_cql(cql, limit=200):
+                task.check_cancelled()
+                if not response.ok:
+                    print(response.text)
+                    run_on_ui(sublime.error_message, "Can not list pages of space {}, reason: {}".format(
+                        space_key, response.reason))
+                    return
+                current.update(page["id"] for page in response.json()["results"])
+            gone = index.page_ids(space_key) - current
+            index.remove_pages(gone)
+            removed = len(gone)
+        index.mark_synced(space_key, started)
+        run_on_ui(sublime.status_message, "Indexed {} page(s) of {}, removed {}, in {:.1f}s".format(
+            count, space_key, removed, time.time() - started))
+
+
+class CancelConfluenceOperationCommand(sublime_plugin.WindowCommand):
+    def run(self):
+        tasks = get_executor().cancel_all()
+        if tasks:
+            sublime.status_message("Cancelling {} Confluence operation(s)".format(len(tasks)))
+        else:
+            sublime.status_message("No Confluence operation is running")
+
+
+def render_preview(contents, syntax, filename, extras=None):
+    """
+    Render a source view to the storage format the update commands would
+    send, without uploading anything.
+    """
+    markup = confluence_core.Markup(extras=extras)
+    if markup.syntax_name(syntax) not in markup.markups:
+        return "<!-- Live preview supports Markdown and reStructuredText -->\n"
+    meta, content = markup.get_meta_and_content(contents)
+    html = markup.to_html("\n".join(content) if meta else contents, syntax)
+    if isinstance(html, bytes):
+        html = html.decode("utf-8")
+    if not html:
+        return "<!-- Can not parse this document -->\n"
+    data = dict(body=dict(storage=dict(value=html, representation="storage")))
+    data, images = ConfluenceApi.extract_images(data, source_filename=filename or "/")
+    return data["body"]["storage"]["value"]
+
+
+class ConfluencePreview(object):
+    """
+    Keeps the preview view of one source view up to date: edits are
+    debounced, rendered on the preview thread and only the result of the
+    latest edit is shown.
+    """
+
+    def __init__(self, source, preview):
+        self.source = source
+        self.preview = preview
+        self.generation = 0
+
+    def schedule(self, delay):
+        self.generation += 1
+        generation = self.generation
+        sublime.set_timeout_async(lambda: self.start(generation), delay)
+
+    def start(self, generation):
+        if generation != self.generation:
+            return
+        contents = self.source.substr(sublime.Region(0, self.source.size()))
+        syntax = self.source.settings().get("syntax")
+        extras = sublime.load_settings("Confluence.sublime-settings").get("markdown_extras")
+        get_preview_renderer().submit(self.render, generation, contents, syntax,
+                                      self.source.file_name(), extras)
+
+    def render(self, generation, contents, syntax, filename, extras):
+        if generation != self.generation:
+            return
+        try:
+            body = render_preview(contents, syntax, filename, extras)
         except Exception:
-            print(response.text)
-            sublime.error_message("Can't delete content, reason: {}".format(response.reason))
+            traceback.print_exc()
+            return
+        run_on_ui(self.show, generation, body)
+
+    def show(self, generation, body):
+        if generation != self.generation or not self.preview.is_valid():
+            return
+        position = self.preview.viewport_position()
+        self.preview.set_read_only(False)
+        self.preview.run_command("select_all")
+        self.preview.run_command("right_delete")
+        self.preview.run_command("append", {"characters": body})
+        self.preview.set_read_only(True)
+        self.preview.set_viewport_position(position, False)
+
+
+PREVIEWS = dict()
+
+
+class ToggleConfluencePreviewCommand(sublime_plugin.TextCommand):
+    """
+    Open, or close, a live preview of the page next to the source view.
+    """
+
+    def run(self, edit):
+        if self.view.settings().get("confluence_preview"):
+            return
+        window = self.view.window()
+        preview = PREVIEWS.pop(self.view.id(), None)
+        if preview is not None:
+            if preview.preview.is_valid():
+                window.focus_view(preview.preview)
+                window.run_command("close_file")
+                window.focus_view(self.view)
+            return
+        if window.num_groups() < 2:
+            window.set_layout({"cols": [0.0, 0.5, 1.0], "rows": [0.0, 1.0],
+                               "cells": [[0, 0, 1, 1], [1, 0, 2, 1]]})
+        group = 1 if window.active_group() == 0 else 0
+        preview_view = window.new_file()
+        window.set_view_index(preview_view, group, len(window.views_in_group(group)))
+        preview_view.set_scratch(True)
+        preview_view.set_name("Preview: {}".format(
+            os.path.basename(self.view.file_name() or self.view.name() or "untitled")))
+        preview_view.set_syntax_file("Packages/HTML/HTML.sublime-syntax")
+        preview_view.settings().set("confluence_preview", True)
+        window.focus_view(self.view)
+        PREVIEWS[self.view.id()] = ConfluencePreview(self.view, preview_view)
+        PREVIEWS[self.view.id()].schedule(0)
+
+
+class ConfluencePreviewListener(sublime_plugin.EventListener):
+    def on_modified_async(self, view):
+        preview = PREVIEWS.get(view.id())
+        if preview is not None:
+            settings = sublime.load_settings("Confluence.sublime-settings")
+            preview.schedule(settings.get("preview_delay", 400))
+
+    def on_close(self, view):
+        PREVIEWS.pop(view.id(), None)
+        if view.settings().get("confluence_preview"):
+            for source_id, preview in list(PREVIEWS.items()):
+                if preview.preview.id() == view.id():
+                    del PREVIEWS[source_id]
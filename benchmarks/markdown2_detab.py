@@ -0,0 +1,80 @@
+"""
+Stress test of markdown2's tab expansion on tab-heavy lines, against the
+recursive implementation it replaced:
+
+    python benchmarks/markdown2_detab.py [--tabs 10000] [--lines 200]
+
+RecursiveMarkdown below restores the old _detab: one recursive call (and
+a rebuilt copy of the line) per tab, so it is quadratic in the tabs of a
+line and fails with RecursionError past ~1000 of them.
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import markdown2
+
+
+class RecursiveMarkdown(markdown2.Markdown):
+    def _detab_line(self, line):
+        if '\t' not in line:
+            return line
+        chunk1, chunk2 = line.split('\t', 1)
+        chunk1 += (' ' * (self.tab_width - len(chunk1) % self.tab_width))
+        output = chunk1 + chunk2
+        return self._detab_line(output)
+
+    def _detab(self, text):
+        if '\t' not in text:
+            return text
+        output = []
+        for line in text.splitlines():
+            output.append(self._detab_line(line))
+        return '\n'.join(output)
+
+
+def tsv(tabs, lines):
+    """
+    A pasted TSV table: lines of `tabs` tab separated cells.
+    """
+    return "\n".join("\t".join("c{}x{}".format(row, cell) for cell in range(tabs + 1))
+                     for row in range(lines)) + "\n"
+
+
+def timed(converter, text):
+    started = time.perf_counter()
+    try:
+        output = converter._detab(text)
+    except RecursionError:
+        return None, None
+    return time.perf_counter() - started, output
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--tabs", type=int, default=10000, help="tabs per line of the largest case")
+    parser.add_argument("--lines", type=int, default=200)
+    args = parser.parse_args(argv)
+    recursive = RecursiveMarkdown()
+    linear = markdown2.Markdown()
+    print("{:>8} {:>6} {:>12} {:>12}".format("tabs", "lines", "recursive", "linear"))
+    counts = [10 ** power for power in range(1, 8) if 10 ** power < args.tabs] + [args.tabs]
+    for tabs in counts:
+        for lines in (1, args.lines):
+            text = tsv(tabs, lines)
+            old_time, old_output = timed(recursive, text)
+            new_time, new_output = timed(linear, text)
+            if old_output is not None and old_output != new_output:
+                sys.exit("outputs differ at {} tabs".format(tabs))
+            print("{:>8} {:>6} {:>12} {:>11.4f}s".format(
+                tabs, lines, "RecursionError" if old_time is None else "{:.4f}s".format(old_time), new_time))
+    started = time.perf_counter()
+    linear.convert(tsv(args.tabs, args.lines))
+    print("convert() of {} lines with {} tabs each: {:.3f}s".format(
+        args.lines, args.tabs, time.perf_counter() - started))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""
+Compares markdown2's placeholder hashing with the md5 hashing it replaced
+on a corpus of HTML-heavy pages:
+
+    python benchmarks/markdown2_hashing.py [--pages 10] [--repeat 3]
+
+Md5Markdown below restores the old behaviour: an md5 hash per hashed
+block, span, code span and escaped character, unhashed with one replace()
+pass per hash.
+"""
+import argparse
+import os
+import sys
+import time
+from hashlib import md5
+from random import Random, randint
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import markdown2
+
+SECRET_SALT = bytes(randint(0, 1000000))
+EXTRAS = ["fenced-code-blocks", "tables"]
+
+
+class Md5Markdown(markdown2.Markdown):
+    def _hash_text(self, s):
+        return 'md5-' + md5(SECRET_SALT + s.encode("utf-8")).hexdigest()
+
+    def _unhash(self, text, table):
+        for s, key in list(table.items()):
+            text = text.replace(key, s)
+        return text
+
+
+BLOCKS = [
+    '<div class="panel">\n<p>Panel {n} with <b>bold</b> and <a href="http://example.com/{n}">a link</a>.</p>\n</div>\n',
+    '<table>\n<tr><th>Key</th><th>Value</th></tr>\n<tr><td>k{n}</td><td>v{n}</td></tr>\n</table>\n',
+    'Paragraph {n} with <span class="status">inline</span> HTML, `code_{n}()`, *emphasis* and \\*escapes\\*.\n',
+    '## Section {n}\n',
+    '* item with <code>tag</code> and [a link](http://example.com/{n})\n* second item\n',
+    '    <pre>indented code {n}</pre>\n',
+    '<!-- comment {n} -->\n',
+]
+
+
+def corpus(pages, blocks_per_page=300, seed=1):
+    random = Random(seed)
+    return ["\n".join(random.choice(BLOCKS).format(n=n) for n in range(blocks_per_page))
+            for _ in range(pages)]
+
+
+def timed(converter_class, documents, repeat):
+    best = None
+    for _ in range(repeat):
+        converter = converter_class(extras=EXTRAS)
+        started = time.perf_counter()
+        for document in documents:
+            converter.convert(document)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--pages", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args(argv)
+    documents = corpus(args.pages)
+    for document in documents:
+        if markdown2.Markdown(extras=EXTRAS).convert(document) != Md5Markdown(extras=EXTRAS).convert(document):
+            sys.exit("outputs differ")
+    size = sum(len(document) for document in documents)
+    print("{} pages, {:.1f} KiB of Markdown".format(len(documents), size / 1024.0))
+    md5_time = timed(Md5Markdown, documents, args.repeat)
+    token_time = timed(markdown2.Markdown, documents, args.repeat)
+    print("md5 hashing:         {:.3f}s".format(md5_time))
+    print("placeholder tokens:  {:.3f}s ({:.2f}x)".format(token_time, md5_time / token_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+"""
+Counts the requests ConfluenceApi sends to a local stub Confluence server
+for a series of page searches, with the session reused (authenticated
+once) and without it (a pre-flight GET before every call, the old
+behaviour):
+
+    python benchmarks/request_count.py [--calls 5]
+
+It then creates a page and republishes it unchanged, with and without a
+PageStore as publish manifest, and counts the PUTs the republish sent.
+
+The stub answers the REST endpoints the client uses with canned JSON and
+counts every request it receives.
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from confluence_core import ConfluenceApi, PageStore
+
+API_PATH = "/confluence/rest/api"
+
+
+class StubConfluence(ThreadingHTTPServer):
+    def __init__(self):
+        ThreadingHTTPServer.__init__(self, ("127.0.0.1", 0), StubHandler)
+        self.lock = threading.Lock()
+        self.requests = []
+        self.page = None
+
+    @property
+    def base_uri(self):
+        return "http://127.0.0.1:{}{}".format(self.server_address[1], API_PATH)
+
+    def reset(self):
+        with self.lock:
+            del self.requests[:]
+            self.page = None
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests.append(("GET", self.path))
+        path = self.path.split("?")[0]
+        if path == API_PATH:
+            self.reply(200, {})
+        elif path == API_PATH + "/content/search":
+            self.reply(200, {"results": [{"id": "1", "title": "Page"}], "_links": {}})
+        elif path == API_PATH + "/content/1" and self.server.page is not None:
+            self.reply(200, self.server.page)
+        else:
+            self.reply(404, {"message": "not found"})
+
+    def do_POST(self):
+        data = self.read_body()
+        if self.path.split("?")[0].rstrip("/") != API_PATH + "/content":
+            self.reply(404, {"message": "not found"})
+            return
+        self.save_page(data, 1)
+
+    def do_PUT(self):
+        data = self.read_body()
+        if self.path.split("?")[0] != API_PATH + "/content/1" or self.server.page is None:
+            self.reply(404, {"message": "not found"})
+            return
+        self.save_page(data, data["version"]["number"])
+
+    def read_body(self):
+        with self.server.lock:
+            self.server.requests.append((self.command, self.path))
+        return json.loads(self.rfile.read(int(self.headers["Content-Length"])).decode("utf-8"))
+
+    def save_page(self, data, version_number):
+        page = dict(data, id="1", version={"number": version_number},
+                    _links={"base": "http://127.0.0.1", "webui": "/pages/1"})
+        self.server.page = page
+        self.reply(200, page)
+
+    def reply(self, status, data):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def count_requests(server, calls, reuse_session):
+    server.reset()
+    confluence_api = ConfluenceApi("user", "secret", server.base_uri, reuse_session=reuse_session)
+    try:
+        for _ in range(calls):
+            if not confluence_api.search_content("DOC", "Page").ok:
+                sys.exit("search failed")
+    finally:
+        confluence_api.close()
+    return len(server.requests), confluence_api.request_count
+
+
+def count_republish_puts(server, store, filename):
+    server.reset()
+    confluence_api = ConfluenceApi("user", "secret", server.base_uri)
+
+    def page_data():
+        return dict(type="page", title="Page", space=dict(key="DOC"),
+                    body=dict(storage=dict(value="<p>Unchanged</p>", representation="storage")))
+    try:
+        response, _ = confluence_api.create_content(page_data(), filename, store=store)
+        if not response.ok:
+            sys.exit("create failed")
+        data = dict(page_data(), id="1", version=dict(number=2, minorEdit=False))
+        response, _ = confluence_api.update_content("1", data, filename, store=store)
+        if not response.ok:
+            sys.exit("update failed")
+    finally:
+        confluence_api.close()
+    return sum(1 for method, _ in server.requests if method == "PUT")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--calls", type=int, default=5)
+    args = parser.parse_args(argv)
+    server = StubConfluence()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        for label, reuse_session in (("pre-flight per call:", False), ("authenticated once:", True)):
+            received, counted = count_requests(server, args.calls, reuse_session)
+            if received != counted:
+                sys.exit("request_count {} but the server received {}".format(counted, received))
+            print("{:<22} {} requests for {} searches".format(label, received, args.calls))
+        state = tempfile.mkdtemp()
+        try:
+            for label, store in (("without manifest:", None),
+                                 ("with manifest:", PageStore(os.path.join(state, "pages.sqlite")))):
+                print("{:<22} {} PUT(s) republishing a created page unchanged".format(
+                    label, count_republish_puts(server, store, os.path.join(state, "page.md"))))
+        finally:
+            shutil.rmtree(state)
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
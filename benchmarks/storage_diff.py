@@ -0,0 +1,94 @@
+"""
+Times StorageDiff on a storage-format page of about 1 MB full of repeated
+blocks such as <p><br /></p>, against the exhaustive block matcher it
+replaced:
+
+    python benchmarks/storage_diff.py [--size 1024] [--repeat 3] [--skip-old]
+
+The old matcher is SequenceMatcher(autojunk=False) over all blocks, which
+is quadratic in the number of identical blocks.
+"""
+import argparse
+import difflib
+import os
+import sys
+import time
+from random import Random
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from confluence_core import StorageDiff
+
+BLOCKS = [
+    '<p><br /></p>',
+    '<p><br /></p>',
+    '<p><br /></p>',
+    '<hr />',
+    '<p>Paragraph {n} with <strong>bold</strong> and <a href="http://example.com/{n}">a link</a>.</p>',
+    '<h2>Section {n}</h2>',
+    '<ul><li>item</li><li>second item</li></ul>',
+    '<table><tbody><tr><th>Key</th><th>Value</th></tr><tr><td>k{n}</td><td>v{n}</td></tr></tbody></table>',
+]
+
+
+def page(size_kib, seed=1):
+    random = Random(seed)
+    blocks = []
+    length = n = 0
+    while length < size_kib * 1024:
+        block = random.choice(BLOCKS).format(n=n)
+        blocks.append(block)
+        length += len(block) + 1
+        n += 1
+    return blocks
+
+
+def edited(blocks, seed=2):
+    random = Random(seed)
+    blocks = list(blocks)
+    for _ in range(20):
+        position = random.randrange(len(blocks))
+        if random.random() < 0.5:
+            blocks.insert(position, '<p><br /></p>')
+        else:
+            blocks[position] = '<p>Edited paragraph {}.</p>'.format(position)
+    return blocks
+
+
+def old_opcodes(old, new):
+    matcher = difflib.SequenceMatcher(
+        None, [StorageDiff.normalize(block) for block in StorageDiff.split_blocks(old)],
+        [StorageDiff.normalize(block) for block in StorageDiff.split_blocks(new)], autojunk=False)
+    return [opcode for opcode in matcher.get_opcodes() if opcode[0] != "equal"]
+
+
+def timed(function, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--size", type=int, default=1024, help="page size in KiB")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--skip-old", action="store_true", help="do not time the old matcher")
+    args = parser.parse_args(argv)
+    blocks = page(args.size)
+    old = "\n".join(blocks)
+    new = "\n".join(edited(blocks))
+    print("{:.1f} KiB page, {} blocks, {} of them <p><br /></p>".format(
+        len(old) / 1024.0, len(blocks), blocks.count('<p><br /></p>')))
+    diff = StorageDiff(old, new)
+    print("{} changed block(s), {} characters of text changed".format(
+        sum(max(i2 - i1, j2 - j1) for tag, i1, i2, j1, j2 in diff.opcodes), diff.changed_text_size()))
+    print("StorageDiff:          {:.3f}s".format(timed(lambda: StorageDiff(old, new), args.repeat)))
+    if not args.skip_old:
+        print("exhaustive matcher:   {:.3f}s".format(timed(lambda: old_opcodes(old, new), 1)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1752 @@
+"""
+Confluence REST client, markup rendering and folder publishing. Nothing
+here depends on Sublime Text, so the plugin and the command-line publisher
+(confluence_core/cli.py) share it. It is a package rather than a top-level
+module so Sublime does not load it as a plugin.
+"""
+import bisect
+import codecs
+import difflib
+import gzip
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from email.utils import mktime_tz, parsedate_tz
+
+import requests
+
+try:
+    import sqlite3
+    PAGE_STORE = True
+except ImportError:
+    PAGE_STORE = False
+
+try:
+    import lxml.html
+    from lxml import etree
+    HTML_PRETTIFY = True
+except ImportError:
+    HTML_PRETTIFY = False
+
+
+# markdown2 lives next to the package
+abspath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if abspath not in sys.path:
+    sys.path.append(abspath)
+import markdown2
+
+# Diagnostics go through logging so the command-line publisher keeps stdout
+# for its summary, the plugin sends them to the Sublime console
+logger = logging.getLogger(__name__)
+
+
+class ConfluenceError(Exception):
+    pass
+
+
+def file_sha256(path, chunk_size=65536):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class MultipartFileStream(object):
+    """
+    multipart/form-data body streaming one file in CHUNK_SIZE pieces, so the
+    upload never holds the whole file in memory. Every iteration opens and
+    closes its own file handle, which keeps the body replayable.
+    """
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, filename, path, content_type, fields=None, progress=None):
+        self.path = path
+        self.filename = filename
+        self.progress = progress
+        self.size = os.path.getsize(path)
+        self.boundary = uuid.uuid4().hex
+        head = []
+        for name, value in (fields or {}).items():
+            head.append("--{}\r\nContent-Disposition: form-data; name=\"{}\"\r\n\r\n{}\r\n".format(
+                self.boundary, name, value))
+        head.append("--{}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"{}\"\r\n"
+                    "Content-Type: {}\r\n\r\n".format(
+                        self.boundary, filename.replace('"', "%22"), content_type))
+        self.head = "".join(head).encode("utf-8")
+        self.tail = "\r\n--{}--\r\n".format(self.boundary).encode("utf-8")
+
+    @property
+    def content_type(self):
+        return "multipart/form-data; boundary={}".format(self.boundary)
+
+    def __len__(self):
+        return len(self.head) + self.size + len(self.tail)
+
+    def __iter__(self):
+        yield self.head
+        sent = 0
+        with open(self.path, "rb") as f:
+            for chunk in iter(lambda: f.read(self.CHUNK_SIZE), b""):
+                sent += len(chunk)
+                if self.progress:
+                    self.progress(self.filename, sent, self.size)
+                yield chunk
+        yield self.tail
+
+
+class TokenBucket(object):
+    """
+    Thread-safe token bucket refilled at rate tokens per second up to
+    capacity. A rate of None disables limiting.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        # Below one token acquire() would wait forever
+        self.capacity = max(1, capacity or 1)
+        self.tokens = self.capacity
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self):
+        if not self.rate:
+            return True
+        with self.lock:
+            self._refill(time.time())
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+    def acquire(self):
+        if not self.rate:
+            return
+        while True:
+            with self.lock:
+                self._refill(time.time())
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class RetryPolicy(object):
+    """
+    Decides whether and when a failed call is retried: 429 for any method,
+    5xx and connection errors for idempotent methods only. Honors
+    Retry-After, otherwise backs off exponentially with full jitter, within
+    a per-operation deadline and a retry budget shared by all clients.
+    """
+    IDEMPOTENT_METHODS = ("get", "head", "options", "put", "delete")
+    RETRY_STATUS_CODES = (500, 502, 503, 504)
+
+    def __init__(self, max_retries=4, backoff=0.5, backoff_max=30, deadline=120, budget=None):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.deadline = deadline
+        self.budget = budget or TokenBucket(None, 0)
+
+    def retry_after(self, response):
+        value = response.headers.get("Retry-After")
+        if not value:
+            return None
+        if value.strip().isdigit():
+            return int(value)
+        parsed = parsedate_tz(value)
+        if parsed is None:
+            return None
+        return max(0, mktime_tz(parsed) - time.time())
+
+    def next_delay(self, method, attempt, started, response=None):
+        """
+        Seconds to wait before retry number attempt + 1, or None to give up.
+        response is None when the call failed with a connection error.
+        """
+        if attempt >= self.max_retries:
+            return None
+        idempotent = method.lower() in self.IDEMPOTENT_METHODS
+        delay = None
+        if response is None:
+            if not idempotent:
+                return None
+        elif response.status_code == 429:
+            delay = self.retry_after(response)
+        elif response.status_code in self.RETRY_STATUS_CODES and idempotent:
+            delay = self.retry_after(response)
+        else:
+            return None
+        if delay is None:
+            delay = random.uniform(0, min(self.backoff_max, self.backoff * 2 ** attempt))
+        if time.time() + delay - started > self.deadline:
+            return None
+        if not self.budget.try_acquire():
+            logger.warning("Confluence retry budget exhausted")
+            return None
+        return delay
+
+
+RETRY_WAITS = threading.local()
+
+
+def set_retry_cancel_event(event):
+    """
+    Make retry waits on the calling thread end as soon as event is set,
+    None restores plain sleeps.
+    """
+    RETRY_WAITS.cancel_event = event
+
+
+def wait_before_retry(delay):
+    """
+    Sleep delay seconds before a retry, return True when the calling
+    thread's operation was cancelled meanwhile.
+    """
+    event = getattr(RETRY_WAITS, "cancel_event", None)
+    if event is None:
+        time.sleep(delay)
+        return False
+    return event.wait(delay)
+
+
+def with_retry_cancel_event(fn):
+    """
+    Wrap fn to wait for retries under the calling thread's cancel event
+    when it runs on another thread.
+    """
+    event = getattr(RETRY_WAITS, "cancel_event", None)
+
+    def run(*args, **kwargs):
+        set_retry_cancel_event(event)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            set_retry_cancel_event(None)
+    return run
+
+
+class ContentCache(object):
+    """
+    LRU cache of get_content_by_id responses keyed by content id, each entry
+    remembers the page version and ETag it was fetched at.
+    """
+
+    def __init__(self, max_entries=50):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, content_id):
+        with self.lock:
+            entry = self.entries.get(content_id)
+            if entry is not None:
+                self.entries.move_to_end(content_id)
+            return entry
+
+    def put(self, content_id, response):
+        if not self.max_entries:
+            return
+        entry = dict(version=response.json()["version"]["number"],
+                     etag=response.headers.get("ETag"), response=response)
+        with self.lock:
+            self.entries[content_id] = entry
+            self.entries.move_to_end(content_id)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, content_id):
+        with self.lock:
+            self.entries.pop(content_id, None)
+
+
+class ConfluenceApi(object):
+    # Status codes meaning the session cookie is no longer accepted
+    AUTH_FAILURE_CODES = (401, 403)
+    # Update status codes meaning the page a title resolved to is stale:
+    # deleted, or saved or renamed by somebody else meanwhile
+    STALE_TARGET_CODES = (404, 409)
+    # Attachment comment carrying the uploaded file's content hash
+    ATTACHMENT_HASH_PREFIX = "sha256:"
+    # Request bodies smaller than this are not worth compressing
+    COMPRESS_MIN_SIZE = 1024
+
+    def __init__(self, username, password, base_uri, reuse_session=True, pool_size=10,
+                 max_parallel_uploads=4, timeout=60, retry_policy=None, rate_limiter=None,
+                 content_cache_size=50, compress_requests=False):
+        self.username = username
+        self.password = password
+        self.base_uri = base_uri
+        self.reuse_session = reuse_session
+        self.max_parallel_uploads = max_parallel_uploads
+        self.timeout = timeout
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.rate_limiter = rate_limiter or TokenBucket(None, 0)
+        self.content_cache = ContentCache(content_cache_size)
+        self.compress_requests = compress_requests
+        self.session = requests.Session()
+        self.session.auth = requests.auth.HTTPBasicAuth(self.username, self.password)
+        self.session.headers["Connection"] = "keep-alive"
+        self.session.headers["Accept-Encoding"] = "gzip, deflate"
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.authenticated = False
+        self.auth_expires = None
+        self.request_count = 0
+        self.count_lock = threading.Lock()
+        logger.info("ConfluenceApi username: %s, password: %s, base_uri: %s",
+                    self.username, "*" * len(self.password), self.base_uri)
+
+    def _send(self, method, url, **kwargs):
+        self.rate_limiter.acquire()
+        with self.count_lock:
+            self.request_count += 1
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session.request(method, url, **kwargs)
+
+    def _auth_expired(self):
+        if not self.authenticated:
+            return True
+        return self.auth_expires is not None and time.time() >= self.auth_expires
+
+    def authenticate(self):
+        """
+        Ensure we are authenticated (set cookie, session, etc.), remember the
+        earliest cookie expiry so the session can be renewed before it lapses.
+        """
+        response = self._send("get", self.base_uri, verify=False)
+        self.authenticated = response.status_code not in self.AUTH_FAILURE_CODES
+        expires = [cookie.expires for cookie in self.session.cookies if cookie.expires]
+        self.auth_expires = min(expires) if expires else None
+        return response
+
+    def _request(self, method, sub_uri, params=None, **kwargs):
+        url = "{}/{}".format(self.base_uri, sub_uri)
+
+        headers = {"Content-Type": "application/json"}
+        if "headers" in kwargs:
+            if not kwargs["headers"] is None:
+                headers = kwargs["headers"]  # headers.update(kwargs["headers"])
+            kwargs.pop("headers", None)
+
+        if params:
+            kwargs.update(params=params)
+        if not self.reuse_session or self._auth_expired():
+            self.authenticate()
+        started = time.time()
+        attempt = 0
+        reauthenticated = False
+        while True:
+            # Make the "real" call
+            try:
+                response = self._send(method, url, headers=headers, verify=False, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                delay = self.retry_policy.next_delay(method, attempt, started)
+                if delay is None:
+                    raise
+                logger.warning("Confluence %s %s failed (%s), retry in %.1fs",
+                               method.upper(), sub_uri, e, delay)
+                if wait_before_retry(delay):
+                    raise
+            else:
+                if (self.reuse_session and not reauthenticated and
+                        response.status_code in self.AUTH_FAILURE_CODES):
+                    # Session cookie was rejected, log in again and replay the call once
+                    reauthenticated = True
+                    self.authenticated = False
+                    self.authenticate()
+                    continue
+                delay = self.retry_policy.next_delay(method, attempt, started, response)
+                if delay is None:
+                    return response
+                logger.warning("Confluence %s %s returned %s, retry in %.1fs",
+                               method.upper(), sub_uri, response.status_code, delay)
+                if wait_before_retry(delay):
+                    return response
+            attempt += 1
+
+    def encode_payload(self, data):
+        """
+        Encode data as compact UTF-8 JSON, gzipped when compress_requests is
+        on and the body is large enough to benefit.
+        """
+        text = json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+        body = text.encode("utf-8")
+        headers = {"Content-Type": "application/json; charset=utf-8"}
+        encoded_size = len(body)
+        if self.compress_requests and encoded_size >= self.COMPRESS_MIN_SIZE:
+            body = gzip.compress(body)
+            headers["Content-Encoding"] = "gzip"
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("Payload size: %s bytes as escaped JSON, %s bytes as UTF-8 JSON, %s bytes sent",
+                        self.escaped_json_size(text, encoded_size), encoded_size, len(body))
+        return body, headers
+
+    @staticmethod
+    def escaped_json_size(text, utf8_size):
+        """
+        Size text would have as ensure_ascii JSON, counted in one pass over
+        the characters rather than by encoding it again: every non-ASCII
+        character and DEL becomes a 6 byte \\uXXXX escape, astral ones a 12
+        byte surrogate pair.
+        """
+        if utf8_size == len(text) and "\x7f" not in text:
+            return utf8_size
+        size = len(text)
+        for c in text:
+            if c >= "\x7f":
+                size += 11 if c > "\uffff" else 5
+        return size
+
+    def _post(self, url, data=None):
+        body, headers = self.encode_payload(data)
+        return self._request("post", url, data=body, headers=headers)
+
+    def _get(self, url, params=None):
+        return self._request("get", url, params=params)
+
+    def _put(self, url, data=None, files=None, headers=None):
+        if data is None:
+            return self._request("put", url, files=files, headers=headers)
+        else:
+            body, payload_headers = self.encode_payload(data)
+            payload_headers.update(headers or {})
+            return self._request("put", url, data=body, files=files, headers=payload_headers)
+
+    def _delete(self, url, params=None):
+        return self._request("delete", url, params=params)
+
+    @staticmethod
+    def extract_images(content_data, source_filename="/"):
+        if HTML_PRETTIFY:
+            doc = lxml.html.fromstring(content_data['body']['storage']['value'])
+
+            file_dir = os.path.dirname(os.path.abspath(source_filename))
+            logger.debug("Extract files form: %s", file_dir)
+            if not file_dir[-1] in "/\\":
+                if sys.platform == "win32" or sys.platform == "win32":
+                    file_dir += "\\"
+                else:
+                    file_dir += "/"
+
+            resources = []
+
+            for img in doc.xpath('//img'):
+                img.tag = "ac:image"
+                _src = (img.get('src')).replace("%20", " ")
+                img.attrib.clear()
+                # w, h = Image.open(file_dir + _src).size
+                w = 500
+                img.attrib["ac:width"] = "{}".format(min(w, 500))
+                img.attrib["ac:align"] = "center"
+
+                if os.path.isfile(file_dir + _src):
+                    resources.append(dict({"filename": os.path.basename(file_dir + _src),
+                                           "fullpath": file_dir + _src}))
+                    _template = "<ri:attachment ri:filename=\"%s\" />" % os.path.basename(file_dir + _src)
+                    link = lxml.html.fromstring(_template)  # .find('.//attachment')
+                    link.tag = "ri:attachment"
+                    img.insert(1, link)
+
+            _tmp_cont = lxml.html.tostring(doc, pretty_print=True, encoding="utf-8").decode("utf-8")
+            _tmp_cont =  _tmp_cont.replace("[TOC]", "<ac:structured-macro ac:name=\"toc\" ac:schema-version=\"1\" />")
+            _tmp_cont = _tmp_cont.replace("atl_conf_", "ac:")
+            _tmp_cont = _tmp_cont.replace("res_id_", "ri:")
+            content_data['body']['storage']['value'] = _tmp_cont
+
+            return content_data, resources
+        else:
+            return content_data, []
+
+    def upload_child_attachment(self, content_id, attachment_dict, progress=None):
+        content_type, encoding = mimetypes.guess_type(attachment_dict["fullpath"])
+        if content_type is None:
+            content_type = 'application/octet-stream'
+        sha256 = attachment_dict.get("sha256") or file_sha256(attachment_dict["fullpath"])
+        stream = MultipartFileStream(
+            attachment_dict["filename"], attachment_dict["fullpath"], content_type,
+            fields={"comment": "{}{}".format(self.ATTACHMENT_HASH_PREFIX, sha256)},
+            progress=progress)
+        return self._request("put", "content/{}/child/attachment".format(content_id),
+                             data=stream,
+                             headers={'X-Atlassian-Token': 'no-check',
+                                      'Content-Type': stream.content_type})
+
+    def get_child_attachments(self, content_id):
+        return self._get("content/{}/child/attachment".format(content_id),
+                         params={"limit": 500, "expand": "extensions"})
+
+    def changed_attachments(self, content_id, resources):
+        """
+        Drop resources whose size and SHA-256 (kept in the attachment comment
+        on upload) match the attachment already stored on the page.
+        """
+        response = self.get_child_attachments(content_id)
+        if not response.ok:
+            logger.warning("Can not list attachments, uploading all: %s", response.reason)
+            return resources
+        remote = dict()
+        for attachment in response.json()["results"]:
+            extensions = attachment.get("extensions", {})
+            match = re.match(r"{}([0-9a-f]{{64}})".format(self.ATTACHMENT_HASH_PREFIX),
+                             extensions.get("comment") or "")
+            if match:
+                remote[attachment["title"]] = (extensions.get("fileSize"), match.group(1))
+        changed = []
+        for img in resources:
+            known = remote.get(img["filename"])
+            if known and known[0] == os.path.getsize(img["fullpath"]):
+                img["sha256"] = img.get("sha256") or file_sha256(img["fullpath"])
+                if img["sha256"] == known[1]:
+                    continue
+            changed.append(img)
+        logger.info("Attachments unchanged: %s, to upload: %s", len(resources) - len(changed), len(changed))
+        return changed
+
+    def _upload_one(self, content_id, attachment_dict, progress=None):
+        try:
+            return self.upload_child_attachment(content_id, attachment_dict, progress)
+        except (requests.RequestException, IOError) as e:
+            return e
+
+    def create_or_update_attachments(self, content_id, resources, progress=None):
+        """
+        Upload resources with at most max_parallel_uploads requests in flight,
+        every file is attempted and the outcome collected in one report.
+        progress(filename, sent, total) is called from the upload threads.
+        """
+        report = AttachmentUploadReport()
+        if not resources:
+            return report
+        workers = max(1, min(self.max_parallel_uploads, len(resources)))
+        upload_one = with_retry_cancel_event(self._upload_one)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            uploads = [pool.submit(upload_one, content_id, img, progress) for img in resources]
+            for img, upload in zip(resources, uploads):
+                report.add(img["filename"], upload.result())
+        logger.log(logging.INFO if report.ok else logging.WARNING, "%s", report.text)
+        return report
+
+    def create_content(self, content_data, filename=None, progress=None, store=None):
+        """
+        Create the page and upload its attachments. With a store, the page is
+        recorded as published so an unchanged republish is skipped.
+        """
+        new_content_data, images = self.extract_images(content_data, source_filename=filename)
+
+        update_content_resp = self._post("content/", data=new_content_data)
+        if not update_content_resp.ok:
+            return update_content_resp, new_content_data
+
+        content_id = self.get_content_id(update_content_resp.json())
+        if images:
+            upload_resp = self.create_or_update_attachments(content_id, images, progress)
+            if not upload_resp.ok:
+                return upload_resp, new_content_data
+        if store:
+            store.record_published(content_id, self.publish_digest(new_content_data, images),
+                                   update_content_resp.json())
+        return update_content_resp, new_content_data
+
+    def search_cql(self, cql, start=0, limit=25, expand=None):
+        params = {"cql": cql, "start": start, "limit": limit}
+        if expand:
+            params["expand"] = expand
+        return self._get("content/search", params=params)
+
+    def search_content(self, space_key, title, start=0, limit=25):
+        cql = "type=page AND space=\"{}\" AND title~\"{}\"".format(space_key, title)
+        return self.search_cql(cql, start=start, limit=limit)
+
+    def has_next_page(self, search_result, limit):
+        results = search_result["results"]
+        links = search_result.get("_links")
+        if not results:
+            return False
+        if links is not None and "next" in links:
+            return True
+        return len(results) >= limit and links is None
+
+    def iter_cql(self, cql, limit=25, start=0, expand=None):
+        """
+        Lazily walk the CQL search result pages from start, yielding one
+        response per page of at most limit results. Follows the next link
+        when the server sends one, cursor-paginated servers need it, else
+        advances start. Stops after a failed response.
+        """
+        response = self.search_cql(cql, start=start, limit=limit, expand=expand)
+        while True:
+            yield response
+            if not response.ok or not self.has_next_page(response.json(), limit):
+                return
+            next_uri = self.next_page_uri(response.json())
+            if next_uri is not None:
+                response = self._get(next_uri)
+            else:
+                start += len(response.json()["results"])
+                response = self.search_cql(cql, start=start, limit=limit, expand=expand)
+
+    def next_page_uri(self, search_result):
+        """
+        The next link of a result page relative to base_uri, or None. The
+        link starts with the server's context path, e.g.
+        /confluence/rest/api/content/search?cql=...&cursor=...
+        """
+        next_link = (search_result.get("_links") or {}).get("next")
+        if not next_link:
+            return None
+        api_path = "/rest/api/"
+        if api_path not in next_link:
+            return None
+        return next_link[next_link.index(api_path) + len(api_path):]
+
+    def iter_search_content(self, space_key, title, limit=25, start=0):
+        cql = "type=page AND space=\"{}\" AND title~\"{}\"".format(space_key, title)
+        return self.iter_cql(cql, limit=limit, start=start)
+
+    def get_content_by_id(self, content_id):
+        """
+        Return the page with its storage body, served from the content cache
+        when the server reports the cached version is still current: by a 304
+        to If-None-Match when it sent an ETag, else by a version-only lookup.
+        """
+        content_id = "{}".format(content_id)
+        cached = self.content_cache.get(content_id)
+        headers = {"Content-Type": "application/json"}
+        if cached is not None:
+            if cached["etag"]:
+                headers["If-None-Match"] = cached["etag"]
+            else:
+                version_resp = self._get("content/{}?expand=version".format(content_id))
+                if version_resp.ok and version_resp.json()["version"]["number"] == cached["version"]:
+                    return cached["response"]
+        response = self._request(
+            "get", "content/{}?expand=body.storage,version,space".format(content_id), headers=headers)
+        if response.status_code == 304 and cached is not None:
+            return cached["response"]
+        if response.ok:
+            self.content_cache.put(content_id, response)
+        return response
+
+    def cached_content(self, content_id, version_number):
+        """
+        Return the content cached at version_number, or None.
+        """
+        cached = self.content_cache.get("{}".format(content_id))
+        if cached is not None and cached["version"] == version_number:
+            return cached["response"].json()
+        return None
+
+    def get_content_by_title(self, space_key, title):
+        cql = "type=page AND space=\"{}\" AND title=\"{}\"".format(space_key, title)
+        params = {"cql": cql, "expand": "version"}
+        response = self._get("content/search", params=params)
+        return response
+
+    def cql_string(self, value):
+        return "\"{}\"".format(value.replace("\\", "\\\\").replace("\"", "\\\""))
+
+    def get_contents_by_titles(self, pairs, chunk_size=50):
+        """
+        Look up many (space_key, title) pairs with one `title in (...)` CQL
+        search per chunk_size pairs. Returns (found, response): found maps
+        the pairs that exist to their page, response is the first failed
+        response or else the last one.
+        """
+        found = dict()
+        response = None
+        pairs = list(OrderedDict.fromkeys(pairs))
+        for start in range(0, len(pairs), chunk_size):
+            by_space = OrderedDict()
+            for space_key, title in pairs[start:start + chunk_size]:
+                by_space.setdefault(space_key, []).append(title)
+            cql = "type=page AND ({})".format(" OR ".join(
+                "(space={} AND title in ({}))".format(
+                    self.cql_string(space_key), ", ".join(self.cql_string(title) for title in titles))
+                for space_key, titles in by_space.items()))
+            wanted = dict(((space_key, title.lower()), (space_key, title))
+                          for space_key, titles in by_space.items() for title in titles)
+            for response in self.iter_cql(cql, limit=chunk_size, expand="version,space"):
+                if not response.ok:
+                    return found, response
+                for page in response.json()["results"]:
+                    pair = wanted.get((page["space"]["key"], page["title"].lower()))
+                    if pair is not None:
+                        found[pair] = page
+        return found, response
+
+    def resolve_titles(self, pairs, store=None, refresh=False):
+        """
+        Map (space_key, title) pairs to (id, version), from store's resolution
+        index unless refresh, looking up every miss with one batched search.
+        Returns (resolved, response), response is None when nothing had to be
+        looked up; pages that do not exist are left out of resolved.
+        """
+        resolved = dict()
+        missing = []
+        for pair in pairs:
+            known = store.resolve(*pair) if store and not refresh else None
+            if known:
+                resolved[pair] = known
+            else:
+                missing.append(pair)
+        if not missing:
+            return resolved, None
+        found, response = self.get_contents_by_titles(missing)
+        for pair, page in found.items():
+            resolved[pair] = (page["id"], page["version"]["number"])
+        if store:
+            store.remember_many(pair + resolved[pair] for pair in found)
+        return resolved, response
+
+    def refresh_resolution(self, space_key, title, store=None):
+        """
+        Look (space_key, title) up on the server again after an update of the
+        page it resolved to failed with one of STALE_TARGET_CODES. Returns
+        ((id, version), response), or (None, response) when no page has
+        exactly that title any more, the stale entry is then dropped from
+        store rather than renaming another page back to title.
+        """
+        found, response = self.get_contents_by_titles([(space_key, title)])
+        page = found.get((space_key, title))
+        if page is None or page["title"] != title:
+            if store:
+                store.forget(space_key, title)
+            return None, response
+        if store:
+            store.remember(space_key, title, page["id"], page["version"]["number"])
+        return (page["id"], page["version"]["number"]), response
+
+    def get_content_history(self, content_id):
+        return self._get("content/{}/history".format(content_id))
+
+    def get_content_id(self, content):
+        id = content["id"]
+        return "{}".format(id)
+
+    def get_content_uri(self, content):
+        logger.debug("Page links: %s", content["_links"])
+        base = content["_links"]["base"]
+        webui = content["_links"]["webui"]
+        return "{}{}".format(base, webui)
+
+    def publish_digest(self, content_data, images):
+        """
+        SHA-256 over what an update sends: title, storage body and the
+        content of every attachment.
+        """
+        digest = hashlib.sha256()
+        digest.update(content_data["title"].encode("utf-8"))
+        digest.update(content_data["body"]["storage"]["value"].encode("utf-8"))
+        for img in images:
+            img["sha256"] = img.get("sha256") or file_sha256(img["fullpath"])
+            digest.update("{}:{}".format(img["filename"], img["sha256"]).encode("utf-8"))
+        return digest.hexdigest()
+
+    def update_content(self, content_id, content_data, filename=None, progress=None, store=None,
+                       previous_body=None, minor_edit_threshold=None):
+        """
+        Update the page and upload its changed attachments. With a store, the
+        update is skipped (an UnchangedPage is returned) when the rendered
+        page matches what this client last published as the version being
+        replaced, and a version-only lookup confirms the server is still at
+        that version. With the body of that version and a minor_edit_threshold,
+        the update is saved as a minor edit when it changes no markup and
+        no more text than that.
+        """
+        new_content_data, images = self.extract_images(content_data, source_filename=filename)
+        if previous_body is not None and minor_edit_threshold is not None:
+            diff = StorageDiff(previous_body, new_content_data["body"]["storage"]["value"])
+            new_content_data["version"]["minorEdit"] = diff.is_minor(minor_edit_threshold)
+
+        digest = None
+        if store:
+            digest = self.publish_digest(new_content_data, images)
+            published = store.last_published(content_id)
+            if published and published["sha256"] == digest and \
+                    published["version"] == new_content_data["version"]["number"] - 1:
+                # The known version comes from the index or the view, somebody
+                # may have edited the page on the server since
+                version_resp = self._get("content/{}?expand=version".format(content_id))
+                if version_resp.ok and version_resp.json()["version"]["number"] == published["version"]:
+                    logger.info("Page %s unchanged since version %s, update skipped",
+                                content_id, published["version"])
+                    return UnchangedPage(published["content"]), new_content_data
+
+        self.content_cache.invalidate("{}".format(content_id))
+        update_content_resp = self._put("content/{}".format(content_id),
+                                        data=new_content_data)
+        if not update_content_resp.ok:
+            return update_content_resp, new_content_data
+
+        if images:
+            images = self.changed_attachments(content_id, images)
+        if images:
+            upload_resp = self.create_or_update_attachments(content_id, images, progress)
+            if not upload_resp.ok:
+                return upload_resp, new_content_data
+        if store:
+            store.record_published(content_id, digest, update_content_resp.json())
+        return update_content_resp, new_content_data
+
+    def delete_content(self, content_id):
+        self.content_cache.invalidate("{}".format(content_id))
+        return self._delete("content/{}".format(content_id))
+
+    def close(self):
+        self.session.close()
+
+
+class StorageDiff(object):
+    """
+    Block-level diff of two storage-format bodies: the top-level elements
+    are compared as whole strings so large pages diff quickly, only the
+    changed blocks are compared character by character.
+    """
+    # Starts a new block when lxml is not available to parse the body
+    BLOCK_START = re.compile(
+        r"(?=<(?:p|h[1-6]|ul|ol|table|pre|div|blockquote|hr|ac:structured-macro|ac:layout)[\s>/])")
+    # Changed blocks longer than this are counted as changed outright
+    CHAR_DIFF_MAX = 20000
+
+    # Stretches without a block unique to both sides are matched with
+    # SequenceMatcher, exhaustively only while they are this short
+    EXACT_MATCH_MAX = 200
+
+    def __init__(self, old, new):
+        self.old_blocks = self.split_blocks(old)
+        self.new_blocks = self.split_blocks(new)
+        self.opcodes = self.diff_opcodes([self.normalize(block) for block in self.old_blocks],
+                                         [self.normalize(block) for block in self.new_blocks])
+
+    @classmethod
+    def diff_opcodes(cls, a, b):
+        """
+        Patience-style diff: blocks that occur once on each side anchor the
+        match and the stretches between them are diffed on their own, so
+        pages full of repeated blocks such as <p><br /></p> do not make it
+        quadratic. Returns the non-equal opcodes, as SequenceMatcher would.
+        """
+        matches = []
+        stack = [(0, len(a), 0, len(b))]
+        while stack:
+            alo, ahi, blo, bhi = stack.pop()
+            while alo < ahi and blo < bhi and a[alo] == b[blo]:
+                matches.append((alo, blo, 1))
+                alo += 1
+                blo += 1
+            while alo < ahi and blo < bhi and a[ahi - 1] == b[bhi - 1]:
+                ahi -= 1
+                bhi -= 1
+                matches.append((ahi, bhi, 1))
+            if alo == ahi or blo == bhi:
+                continue
+            anchors = cls.unique_anchors(a, b, alo, ahi, blo, bhi)
+            if anchors:
+                i0, j0 = alo, blo
+                for i, j in anchors:
+                    matches.append((i, j, 1))
+                    stack.append((i0, i, j0, j))
+                    i0, j0 = i + 1, j + 1
+                stack.append((i0, ahi, j0, bhi))
+                continue
+            # Only repeated blocks left, autojunk keeps SequenceMatcher from
+            # pairing every copy with every other in long stretches
+            exact = max(ahi - alo, bhi - blo) <= cls.EXACT_MATCH_MAX
+            matcher = difflib.SequenceMatcher(None, a[alo:ahi], b[blo:bhi], autojunk=not exact)
+            matches.extend((alo + i, blo + j, size) for i, j, size in matcher.get_matching_blocks() if size)
+
+        opcodes = []
+        i = j = 0
+        for ai, bj, size in sorted(matches) + [(len(a), len(b), 0)]:
+            if i < ai and j < bj:
+                opcodes.append(("replace", i, ai, j, bj))
+            elif i < ai:
+                opcodes.append(("delete", i, ai, j, j))
+            elif j < bj:
+                opcodes.append(("insert", i, i, j, bj))
+            i, j = ai + size, bj + size
+        return opcodes
+
+    @staticmethod
+    def unique_anchors(a, b, alo, ahi, blo, bhi):
+        """
+        Pairs (i, j) of blocks occurring once in a[alo:ahi] and once in
+        b[blo:bhi], the longest run of them in the same order on both sides.
+        """
+        counts = {}
+        for block in a[alo:ahi]:
+            counts[block] = counts.get(block, 0) + 1
+        b_index = {}
+        for j in range(blo, bhi):
+            block = b[j]
+            if counts.get(block) == 1:
+                b_index[block] = None if block in b_index else j
+        pairs = [(i, b_index[a[i]]) for i in range(alo, ahi) if b_index.get(a[i]) is not None]
+        if not pairs:
+            return []
+        # Longest increasing subsequence of the b positions
+        tails, tail_positions = [], []
+        previous = [None] * len(pairs)
+        for k, (i, j) in enumerate(pairs):
+            pos = bisect.bisect_left(tail_positions, j)
+            previous[k] = tails[pos - 1] if pos else None
+            if pos == len(tails):
+                tails.append(k)
+                tail_positions.append(j)
+            else:
+                tails[pos] = k
+                tail_positions[pos] = j
+        anchors = []
+        k = tails[-1]
+        while k is not None:
+            anchors.append(pairs[k])
+            k = previous[k]
+        anchors.reverse()
+        return anchors
+
+    @classmethod
+    def split_blocks(cls, body):
+        if not body or not body.strip():
+            return []
+        if HTML_PRETTIFY:
+            try:
+                fragments = lxml.html.fragments_fromstring(body)
+            except (etree.ParserError, ValueError):
+                fragments = None
+            if fragments is not None:
+                return [fragment if isinstance(fragment, str)
+                        else lxml.html.tostring(fragment, encoding="unicode")
+                        for fragment in fragments if not isinstance(fragment, str) or fragment.strip()]
+        return [block for block in cls.BLOCK_START.split(body) if block.strip()]
+
+    @staticmethod
+    def normalize(block):
+        return " ".join(block.split())
+
+    @staticmethod
+    def text(blocks):
+        return " ".join(re.sub(r"<[^>]*>", " ", "".join(blocks)).split())
+
+    @staticmethod
+    def markup(blocks):
+        return [" ".join(tag.split()) for tag in re.findall(r"<[^>]*>", "".join(blocks))]
+
+    def changed(self):
+        return bool(self.opcodes)
+
+    def markup_changed(self):
+        """
+        True when tags or attributes changed, e.g. an image or macro was
+        added or a link target edited.
+        """
+        return any(self.markup(self.old_blocks[i1:i2]) != self.markup(self.new_blocks[j1:j2])
+                   for tag, i1, i2, j1, j2 in self.opcodes)
+
+    def changed_text_size(self):
+        """
+        Characters of visible text inserted, deleted or replaced, markup and
+        whitespace changes count as nothing.
+        """
+        size = 0
+        for tag, i1, i2, j1, j2 in self.opcodes:
+            old_text = self.text(self.old_blocks[i1:i2])
+            new_text = self.text(self.new_blocks[j1:j2])
+            if old_text == new_text:
+                continue
+            if max(len(old_text), len(new_text)) > self.CHAR_DIFF_MAX:
+                size += max(len(old_text), len(new_text))
+                continue
+            matcher = difflib.SequenceMatcher(None, old_text, new_text, autojunk=False)
+            same = sum(block.size for block in matcher.get_matching_blocks())
+            size += max(len(old_text), len(new_text)) - same
+        return size
+
+    def is_minor(self, threshold):
+        """
+        True when only text changed, at most threshold characters of it.
+        """
+        return not self.markup_changed() and self.changed_text_size() <= threshold
+
+    def format(self):
+        if not self.opcodes:
+            return "No changes.\n"
+        lines = ["{} changed block(s), {} characters of text changed{}".format(
+            sum(max(i2 - i1, j2 - j1) for tag, i1, i2, j1, j2 in self.opcodes),
+            self.changed_text_size(), ", markup changed" if self.markup_changed() else "")]
+        for tag, i1, i2, j1, j2 in self.opcodes:
+            lines.append("@@ -{},{} +{},{} @@".format(i1 + 1, i2 - i1, j1 + 1, j2 - j1))
+            for block in self.old_blocks[i1:i2]:
+                lines.extend("-" + line for line in block.splitlines())
+            for block in self.new_blocks[j1:j2]:
+                lines.extend("+" + line for line in block.splitlines())
+        return "\n".join(lines) + "\n"
+
+
+class UnchangedPage(object):
+    """
+    Stands in for the response of an update that was skipped because
+    neither the page nor its version on the server changed since this
+    client published it, json() returns the last published content.
+    """
+    ok = True
+    status_code = 304
+    reason = "Not Modified"
+    text = ""
+
+    def __init__(self, content):
+        self.content = content
+
+    def json(self):
+        return self.content
+
+
+class AttachmentUploadReport(object):
+    """
+    Summary of a batch of attachment uploads, answers like a response
+    (ok, status_code, reason, text) so callers can treat it as one.
+    """
+
+    def __init__(self):
+        self.results = []
+
+    def add(self, filename, result):
+        self.results.append((filename, result))
+
+    @property
+    def failed(self):
+        return [(filename, result) for filename, result in self.results
+                if isinstance(result, Exception) or not result.ok]
+
+    @property
+    def ok(self):
+        return not self.failed
+
+    @property
+    def status_code(self):
+        for _, result in self.failed:
+            return getattr(result, "status_code", None)
+        return 200
+
+    @property
+    def reason(self):
+        if self.ok:
+            return "OK"
+        return "{} of {} attachment(s) failed: {}".format(
+            len(self.failed), len(self.results),
+            ", ".join(filename for filename, _ in self.failed))
+
+    @property
+    def text(self):
+        lines = []
+        for filename, result in self.results:
+            if isinstance(result, Exception):
+                lines.append("{}: {}".format(filename, result))
+            else:
+                lines.append("{}: {} {}".format(filename, result.status_code, result.reason))
+        return "\n".join(lines)
+
+
+class SqliteStore(object):
+    """
+    Base of the on-disk SQLite stores, every statement runs on a short-lived
+    connection under a lock so the stores can be used from worker threads.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    def _execute(self, sql, args=()):
+        with self.lock:
+            db = self._connect()
+            try:
+                with db:
+                    return db.execute(sql, args).fetchall()
+            finally:
+                db.close()
+
+    def _executemany(self, statements):
+        """
+        Run (sql, args) statements in one transaction.
+        """
+        with self.lock:
+            db = self._connect()
+            try:
+                with db:
+                    for sql, args in statements:
+                        db.execute(sql, args)
+            finally:
+                db.close()
+
+
+class PageStore(SqliteStore):
+    """
+    On-disk SQLite store of fetched pages, so reopened pages and search
+    results can be shown before the server answers.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS pages (
+            id TEXT PRIMARY KEY,
+            space TEXT,
+            title TEXT,
+            version INTEGER,
+            body TEXT,
+            content TEXT,
+            fetched_at REAL
+        )
+    """
+    # (space, title) -> (id, version) of pages, lets updates skip the lookup
+    RESOLUTION_SCHEMA = """
+        CREATE TABLE IF NOT EXISTS resolutions (
+            space TEXT,
+            title TEXT,
+            id TEXT,
+            version INTEGER,
+            PRIMARY KEY (space, title)
+        )
+    """
+    # Hash of the last rendered page this client published, per page
+    PUBLISHED_SCHEMA = """
+        CREATE TABLE IF NOT EXISTS published (
+            id TEXT PRIMARY KEY,
+            version INTEGER,
+            sha256 TEXT,
+            content TEXT
+        )
+    """
+
+    def __init__(self, path):
+        super(PageStore, self).__init__(path)
+        self._execute(self.SCHEMA)
+        self._execute("CREATE INDEX IF NOT EXISTS pages_space_title ON pages (space, title)")
+        self._execute(self.RESOLUTION_SCHEMA)
+        self._execute(self.PUBLISHED_SCHEMA)
+
+    def get(self, content_id):
+        rows = self._execute("SELECT content FROM pages WHERE id = ?", ("{}".format(content_id),))
+        return json.loads(rows[0][0]) if rows else None
+
+    def put(self, content):
+        self._execute(
+            "INSERT OR REPLACE INTO pages (id, space, title, version, body, content, fetched_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            ("{}".format(content["id"]), content["space"]["key"], content["title"],
+             content["version"]["number"], content["body"]["storage"]["value"],
+             json.dumps(content), time.time()))
+        self.remember(content["space"]["key"], content["title"], content["id"],
+                      content["version"]["number"])
+
+    def delete(self, content_id):
+        self._execute("DELETE FROM pages WHERE id = ?", ("{}".format(content_id),))
+        self._execute("DELETE FROM resolutions WHERE id = ?", ("{}".format(content_id),))
+        self._execute("DELETE FROM published WHERE id = ?", ("{}".format(content_id),))
+
+    def last_published(self, content_id):
+        rows = self._execute("SELECT version, sha256, content FROM published WHERE id = ?",
+                             ("{}".format(content_id),))
+        if not rows:
+            return None
+        return dict(version=rows[0][0], sha256=rows[0][1], content=json.loads(rows[0][2]))
+
+    def record_published(self, content_id, sha256, content):
+        self._execute("INSERT OR REPLACE INTO published (id, version, sha256, content) VALUES (?, ?, ?, ?)",
+                      ("{}".format(content_id), content["version"]["number"], sha256, json.dumps(content)))
+
+    def resolve(self, space_key, title):
+        rows = self._execute("SELECT id, version FROM resolutions WHERE space = ? AND title = ?",
+                             (space_key, title))
+        return (rows[0][0], rows[0][1]) if rows else None
+
+    def remember(self, space_key, title, content_id, version_number):
+        self._execute("INSERT OR REPLACE INTO resolutions (space, title, id, version) VALUES (?, ?, ?, ?)",
+                      (space_key, title, "{}".format(content_id), version_number))
+
+    def forget(self, space_key, title):
+        self._execute("DELETE FROM resolutions WHERE space = ? AND title = ?", (space_key, title))
+
+    def remember_many(self, entries):
+        """
+        Record (space_key, title, content_id, version_number) entries at once.
+        """
+        self._executemany([
+            ("INSERT OR REPLACE INTO resolutions (space, title, id, version) VALUES (?, ?, ?, ?)",
+             (space_key, title, "{}".format(content_id), version_number))
+            for space_key, title, content_id, version_number in entries])
+
+    def search(self, space_key, title):
+        """
+        Cached pages whose title contains title, in space_key unless None.
+        """
+        sql = "SELECT id, title FROM pages WHERE title LIKE ?"
+        args = ["%{}%".format(title)]
+        if space_key:
+            sql += " AND space = ?"
+            args.append(space_key)
+        return [dict(id=row[0], title=row[1]) for row in self._execute(sql + " ORDER BY title", args)]
+
+
+class MarkdownBlockCache(object):
+    """
+    LRU cache shared by the IncrementalMarkdown converters of one extras
+    configuration, holding link definitions and rendered HTML per block.
+    """
+
+    def __init__(self, max_entries=5000):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+class IncrementalMarkdown(markdown2.Markdown):
+    """
+    Markdown converter that renders a document section by section and
+    reuses the HTML of sections it has seen before, so re-rendering a long
+    document after a small edit only converts the edited section.
+
+    Sections start at an ATX header that follows a blank line outside a
+    fenced block, where every Markdown block ends, and their HTML joins
+    into exactly what convert() returns for the whole text. Each section
+    sees the link definitions of the whole document. Documents with HTML,
+    duplicated link ids, sections the converter can't close on their own,
+    or extras whose state spans the whole document (footnote and header id
+    numbering, toc, metadata) are converted in one piece.
+    """
+    DOCUMENT_EXTRAS = ("footnotes", "header-ids", "toc", "numbering", "metadata",
+                       "markdown-in-html", "xml", "tag-friendly")
+    # Stands in for the header starting the next section: the blocks ending
+    # a section stop differently before a header (of that level) than at
+    # the end of input
+    SECTION_END = "{} section-end-8c2f\n"
+    SECTION_END_HTML = "\n\n<h{0}>section-end-8c2f</h{0}>\n"
+    # Documents with fewer sections are not worth splitting
+    MIN_SECTIONS = 4
+
+    _header_re = re.compile(r"(#{1,6})[ \t]*[^#\s]")
+    _html_re = re.compile(r"<[A-Za-z!?/]")
+    # A block tag starting a line of a paragraph is one the converter could
+    # not match to its closing tag, in the whole document it might match one
+    # in a later section. Placeholders left in the output differ between
+    # conversions, so sections containing one aren't reused either.
+    _paragraph_re = re.compile(r"<p>((?:(?!</p>).)*)</p>", re.S)
+    _stray_block_re = re.compile(r"(?:\A|\n)<(?:%s)\b" % markdown2.Markdown._block_tags_a)
+    # Stripping a link definition also strips the blank lines after it
+    _link_def_start_re = re.compile(r"^[ ]{0,3}\[.+\]:")
+
+    def __init__(self, extras=None, block_cache=None):
+        super(IncrementalMarkdown, self).__init__(extras=extras)
+        self.block_cache = block_cache if block_cache is not None else MarkdownBlockCache()
+        self.context = None
+
+    def reset(self):
+        super(IncrementalMarkdown, self).reset()
+        if self.context:
+            self.urls.update(self.context[0])
+            self.titles.update(self.context[1])
+
+    def split_sections(self, text):
+        """
+        Return the sections of text, or None when it can't be split safely.
+        """
+        if self._html_re.search(text):
+            return None
+        fenced = "fenced-code-blocks" in self.extras
+        fences = [match.span() for match in self._fenced_code_block_re.finditer(text + "\n")] \
+            if fenced else []
+        sections = []
+        lines = []
+        blank = False
+        recent = ["", ""]
+        offset = 0
+        for line in text.split("\n"):
+            while fences and fences[0][1] <= offset:
+                fences.pop(0)
+            in_fence = bool(fences) and fences[0][0] <= offset
+            if fenced and line.startswith("```") and not in_fence:
+                # An unpaired fence may pair with one in another section
+                return None
+            if blank and not in_fence and self._header_re.match(line) and lines and \
+                    not any(self._link_def_start_re.match(previous) for previous in recent):
+                sections.append("\n".join(lines) + "\n")
+                lines = []
+            lines.append(line)
+            blank = not line.strip()
+            if not blank:
+                recent = [recent[1], line]
+            offset += len(line) + 1
+        sections.append("\n".join(lines) + "\n")
+        return sections
+
+    def section_link_definitions(self, section):
+        """
+        Return (urls, titles, empty) for one section: the link definitions
+        it declares and whether nothing else is left of it. Mirrors the
+        steps of convert() that precede stripping link definitions.
+        """
+        key = ("defs", hashlib.sha1(section.encode("utf-8")).hexdigest())
+        defs = self.block_cache.get(key)
+        if defs is None:
+            self.context = None
+            self.reset()
+            text = self._detab(section + "\n\n")
+            text = self._ws_only_line_re.sub("", text)
+            text = self.preprocess(text)
+            if "fenced-code-blocks" in self.extras:
+                text = self._do_fenced_code_blocks(text)
+            text = self._hash_html_blocks(text, raw=True)
+            text = self._strip_link_definitions(text)
+            defs = (dict(self.urls), dict(self.titles), not text.strip())
+            self.block_cache.put(key, defs)
+        return defs
+
+    def convert_incremental(self, text):
+        if not isinstance(text, markdown2.unicode):
+            text = markdown2.unicode(text, "utf-8")
+        if self.safe_mode or self.use_file_vars or \
+                any(extra in self.extras for extra in self.DOCUMENT_EXTRAS):
+            return self.convert(text)
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+        sections = self.split_sections(text)
+        if sections is None or len(sections) < self.MIN_SECTIONS:
+            return self.convert(text)
+
+        urls = dict()
+        titles = dict()
+        empty = set()
+        for section in sections:
+            section_urls, section_titles, section_empty = self.section_link_definitions(section)
+            if set(section_urls).intersection(urls):
+                # The last definition of a repeated link id wins in convert()
+                return self.convert(text)
+            urls.update(section_urls)
+            titles.update(section_titles)
+            if section_empty:
+                empty.add(section)
+
+        fragments = []
+        for index, section in enumerate(sections):
+            if section in empty:
+                continue
+            # The level of the header starting the next section, 0 for none
+            level = len(self._header_re.match(sections[index + 1]).group(1)) \
+                if index + 1 < len(sections) else 0
+            # Key on the definitions the section might refer to only, so a new
+            # link definition doesn't invalidate every section
+            words = " ".join(section.lower().split())
+            refs = sorted(link_id for link_id in urls if " ".join(link_id.split()) in words)
+            context = (dict((link_id, urls[link_id]) for link_id in refs),
+                       dict((link_id, titles[link_id]) for link_id in refs if link_id in titles))
+            key = ("html", hashlib.sha1(section.encode("utf-8")).hexdigest(), level,
+                   json.dumps(context, sort_keys=True))
+            html = self.block_cache.get(key)
+            if html is None:
+                self.context = context
+                try:
+                    html = self.convert(section + self.SECTION_END.format("#" * level) if level else section)
+                finally:
+                    self.context = None
+                section_end = self.SECTION_END_HTML.format(level) if level else "\n"
+                if not html.endswith(section_end):
+                    return self.convert(text)
+                html = html[:-len(section_end)]
+                if markdown2.g_hash_prefix in html or \
+                        any(self._stray_block_re.search(paragraph)
+                            for paragraph in self._paragraph_re.findall(html)):
+                    return self.convert(text)
+                self.block_cache.put(key, html)
+            fragments.append(html)
+        return markdown2.UnicodeWithAttrs("\n\n".join(fragments) + "\n")
+
+
+class MarkdownConverterPool(object):
+    """
+    Idle IncrementalMarkdown instances per extras configuration. Building
+    one compiles its regexes and escape table, reusing them is safe since
+    convert() resets all per-document state; an instance serves one
+    conversion at a time.
+    """
+
+    def __init__(self):
+        self.idle = dict()
+        self.block_caches = dict()
+        self.lock = threading.Lock()
+
+    def acquire(self, extras):
+        with self.lock:
+            converters = self.idle.get(extras)
+            if converters:
+                return converters.pop()
+            block_cache = self.block_caches.setdefault(extras, MarkdownBlockCache())
+        return IncrementalMarkdown(extras=list(extras), block_cache=block_cache)
+
+    def release(self, extras, converter):
+        with self.lock:
+            self.idle.setdefault(extras, []).append(converter)
+
+
+class RenderCache(object):
+    """
+    LRU cache of rendered documents keyed by (content sha256, syntax,
+    extras), holding at most max_size characters of output.
+    """
+
+    def __init__(self, max_size=16 * 1024 * 1024):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def key(self, content, syntax, extras):
+        return (hashlib.sha256(content.encode("utf-8")).hexdigest(), syntax, extras)
+
+    def get(self, key):
+        with self.lock:
+            html = self.entries.get(key)
+            if html is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return html
+
+    def put(self, key, html):
+        if len(html) > self.max_size:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.size -= len(self.entries.pop(key))
+            self.entries[key] = html
+            self.size += len(html)
+            while self.size > self.max_size:
+                self.size -= len(self.entries.popitem(last=False)[1])
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            return dict(hits=self.hits, misses=self.misses, entries=len(self.entries), size=self.size)
+
+
+MARKDOWN_CONVERTERS = MarkdownConverterPool()
+RENDER_CACHE = RenderCache()
+
+
+class Markup(object):
+    """
+    Renders Markdown and reStructuredText to HTML. Errors go through
+    report_error, which the plugin overrides to show a dialog.
+    """
+
+    def __init__(self, extras=None, cache=RENDER_CACHE):
+        self.extras = tuple(sorted(extras or ()))
+        self.cache = cache
+        self.markups = dict([
+            ("Markdown", self.markdown_to_html),
+            ("Markdown Extended", self.markdown_to_html),
+            ("Markdown (Standard)", self.markdown_to_html),
+            ("reStructuredText", self.rst_to_html)])
+
+    def markdown_to_html(self, content):
+        converter = MARKDOWN_CONVERTERS.acquire(self.extras)
+        try:
+            return converter.convert_incremental(content).encode("utf-8").decode()
+        finally:
+            MARKDOWN_CONVERTERS.release(self.extras, converter)
+
+    def report_error(self, message):
+        logger.error("%s", message)
+
+    def rst_to_html(self, content):
+        try:
+            from docutils.core import publish_string
+            return publish_string(content, writer_name="html")
+        except ImportError:
+            error_msg = """
+            RstPreview requires docutils to be installed for the python interpreter that Sublime uses.
+            run: `sudo easy_install-2.6 docutils` and restart Sublime (if on Mac OS X or Linux).
+            For Windows check the docs at https://github.com/d0ugal/RstPreview
+            """
+            self.report_error(error_msg)
+            raise
+
+    def syntax_name(self, syntax):
+        return syntax.split(".")[0].split("/")[-1]
+
+    def to_html(self, content, syntax):
+        syntax = self.syntax_name(syntax)
+        if syntax not in self.markups:
+            self.report_error("Not support {} syntax yet".format(syntax))
+            return
+        else:
+            converter = self.markups[syntax]
+        key = self.cache.key(content, syntax, self.extras) if self.cache is not None else None
+        new_content = self.cache.get(key) if key else None
+        if new_content is None:
+            new_content = converter(content)
+            if new_content and key:
+                self.cache.put(key, new_content)
+        if not new_content:
+            self.report_error("Can not parse this document.")
+        return new_content
+
+    def get_meta_and_content(self, contents):
+        meta = dict()
+        content = list()
+        tmp = contents.splitlines()
+        for x, entry in enumerate(tmp):
+            if entry.strip():
+                if re.match(r"[Ss]pace: *", entry):
+                    meta["space_key"] = re.sub("[^:]*: *", "", entry)
+                elif re.match(r"[Aa]ncestor Title: *", entry):
+                    meta["ancestor_title"] = re.sub("[^:]*: *", "", entry)
+                elif re.match(r"[Tt]itle: *", entry):
+                    meta["title"] = re.sub("[^:]*: *", "", entry)
+            else:
+                content = tmp[x + 1:]
+                break
+        return (meta, content)
+
+
+
+
+class FolderPublisher(object):
+    """
+    Publish Markdown/reStructuredText files, given directly or found below
+    folders, by their Space/Ancestor Title/Title header. Pages run
+    concurrently, a page whose ancestor is another of the files is published
+    after it. progress(message) and cancelled() are optional hooks. The
+    store resolves titles and, unless skip_unchanged is off, skips pages
+    unchanged since they were last published.
+    """
+    SYNTAXES = {".md": "Markdown", ".markdown": "Markdown", ".rst": "reStructuredText"}
+
+    def __init__(self, confluence_api, markup=None, workers=4, store=None, progress=None,
+                 cancelled=None, skip_unchanged=True):
+        self.confluence_api = confluence_api
+        self.markup = markup or Markup()
+        self.workers = workers
+        self.store = store
+        self.manifest = store if skip_unchanged else None
+        self.progress = progress or (lambda message: None)
+        self.cancelled = cancelled or (lambda: False)
+
+    def find_files(self, paths):
+        for path in paths:
+            if not os.path.isdir(path):
+                yield path
+                continue
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    if os.path.splitext(name)[1].lower() in self.SYNTAXES:
+                        yield os.path.join(root, name)
+
+    def collect_pages(self, paths):
+        """
+        Return the pages to publish by (space, title), the results of the
+        files that will not be and the (space, title) keys more than one file
+        declared, none of those files is published.
+        """
+        found = OrderedDict()
+        skipped = []
+        for path in self.find_files(paths):
+            syntax = self.SYNTAXES.get(os.path.splitext(path)[1].lower())
+            if syntax is None:
+                skipped.append(dict(path=path, ok=False, action="skipped", seconds=0,
+                                    reason="not a Markdown or reStructuredText file"))
+                continue
+            try:
+                with codecs.open(path, "r", "utf-8") as f:
+                    meta, content = self.markup.get_meta_and_content(f.read())
+            except (IOError, UnicodeDecodeError) as e:
+                skipped.append(dict(path=path, ok=False, action="failed", seconds=0,
+                                    reason="can not read file: {}".format(e)))
+                continue
+            if not meta.get("space_key") or not meta.get("title"):
+                # A README or CHANGELOG among the docs, not a failure
+                skipped.append(dict(path=path, ok=True, action="skipped", seconds=0,
+                                    reason="no Space/Title header"))
+                continue
+            found.setdefault((meta["space_key"], meta["title"]), []).append(dict(
+                path=path, syntax=syntax, meta=meta, content="\n".join(content)))
+        pages = OrderedDict()
+        duplicates = set()
+        for key, same in found.items():
+            if len(same) == 1:
+                pages[key] = same[0]
+                continue
+            # Whichever the walk reached last would silently win
+            duplicates.add(key)
+            for page in same:
+                skipped.append(dict(path=page["path"], ok=False, action="failed", seconds=0,
+                                    reason="duplicate Space/Title of {}".format(", ".join(
+                                        other["path"] for other in same if other is not page))))
+        return pages, skipped, duplicates
+
+    def publish(self, paths):
+        """
+        Publish paths and return one result dict per file: path, ok, action
+        (created, updated, unchanged, skipped or failed), seconds, reason and on success id and
+        version. Files without a Space/Title header are skipped with ok set,
+        every other skip is a failure. Raises ConfluenceError when the pages
+        can not be looked up.
+        """
+        pages, results, duplicates = self.collect_pages(paths)
+        ancestors = [(key[0], page["meta"]["ancestor_title"]) for key, page in pages.items()
+                     if page["meta"].get("ancestor_title")]
+        resolved, response = self.confluence_api.resolve_titles(list(pages) + ancestors, self.store)
+        if response is not None and not response.ok:
+            logger.error("%s", response.text)
+            raise ConfluenceError("Can not get content by title, reason: {}".format(response.reason))
+        children = dict()
+        roots = []
+        orphans = []
+        for key, page in pages.items():
+            parent = (key[0], page["meta"].get("ancestor_title"))
+            if parent in pages:
+                children.setdefault(parent, []).append(key)
+            elif parent in duplicates:
+                orphans.append(key)
+            else:
+                roots.append(key)
+
+        published = set()
+        for key in orphans:
+            self.skip_tree(key, pages, children, published, results, "ancestor not published")
+        publish_page = with_retry_cancel_event(self.publish_page)
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            running = dict()
+            for key in roots:
+                running[pool.submit(publish_page, pages[key], resolved)] = key
+            while running:
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    key = running.pop(future)
+                    result = future.result()
+                    results.append(result)
+                    published.add(key)
+                    self.progress("Publishing: {} of {} pages".format(len(published), len(pages)))
+                    for child in children.get(key, []):
+                        if result["ok"] and not self.cancelled():
+                            resolved[key] = (result["id"], result["version"])
+                            running[pool.submit(publish_page, pages[child], resolved)] = child
+                        else:
+                            self.skip_tree(child, pages, children, published, results,
+                                           "cancelled" if self.cancelled() else "ancestor not published")
+        for key, page in pages.items():
+            if key not in published:
+                results.append(dict(path=page["path"], ok=False, action="skipped", seconds=0,
+                                    reason="ancestor cycle"))
+        return results
+
+    def skip_tree(self, key, pages, children, published, results, reason):
+        published.add(key)
+        results.append(dict(path=pages[key]["path"], ok=False, action="skipped", seconds=0,
+                            reason=reason))
+        for child in children.get(key, []):
+            self.skip_tree(child, pages, children, published, results, reason)
+
+    def publish_page(self, page, resolved):
+        started = time.time()
+        meta = page["meta"]
+        key = (meta["space_key"], meta["title"])
+        result = dict(path=page["path"], ok=False, action="", seconds=0)
+        if self.cancelled():
+            # Every root page is queued at once, stop the ones not started yet
+            result.update(action="skipped", reason="cancelled")
+            return result
+        try:
+            new_content = self.markup.to_html(page["content"], page["syntax"])
+            if not new_content:
+                # Publishing it would wipe the page
+                result["action"] = "skipped"
+                result["reason"] = "can not render {}".format(page["syntax"])
+                return result
+            space = dict(key=meta["space_key"])
+            response = None
+            if key in resolved:
+                result["action"] = "updated"
+                for attempt in range(2):
+                    content_id, version_number = resolved[key]
+                    version = dict(number=version_number + 1, minorEdit=False)
+                    # update_content rewrites the body in place, build it afresh per attempt
+                    data = dict(id=content_id, type="page", title=meta["title"],
+                                space=space, version=version,
+                                body=dict(storage=dict(value=new_content, representation="storage")))
+                    response, _ = self.confluence_api.update_content(content_id, data, page["path"],
+                                                                     store=self.manifest)
+                    if response.status_code not in self.confluence_api.STALE_TARGET_CODES or attempt:
+                        break
+                    refreshed, lookup = self.confluence_api.refresh_resolution(*key, store=self.store)
+                    if refreshed is None:
+                        if lookup.ok:
+                            # No page has this title any more, publish it afresh
+                            response = None
+                        break
+                    resolved[key] = refreshed
+            if response is None:
+                result["action"] = "created"
+                ancestor = resolved.get((meta["space_key"], meta.get("ancestor_title")))
+                if ancestor is None:
+                    result["reason"] = "ancestor {} not found".format(meta.get("ancestor_title"))
+                    return result
+                body = dict(storage=dict(value=new_content, representation="storage"))
+                data = dict(type="page", title=meta["title"], ancestors=[dict(id=int(ancestor[0]))],
+                            space=space, body=body)
+                response, _ = self.confluence_api.create_content(data, page["path"], store=self.manifest)
+            result["ok"] = response.ok
+            result["reason"] = response.reason
+            if isinstance(response, UnchangedPage):
+                result["action"] = "unchanged"
+            if response.ok:
+                content = response.json()
+                result["id"] = content["id"]
+                result["version"] = content["version"]["number"]
+                if self.store:
+                    self.store.remember(meta["space_key"], meta["title"], result["id"], result["version"])
+        except Exception as e:
+            logger.exception("Can not publish %s", page["path"])
+            result["action"] = "failed"
+            result["reason"] = "{}".format(e)
+        finally:
+            result["seconds"] = time.time() - started
+        return result
@@ -0,0 +1,98 @@
+"""
+Headless Confluence publisher for build agents:
+
+    python -m confluence_core.cli --base-uri https://confluence.example.com/confluence/rest/api \
+        --username ci docs/
+
+The password is read from the CONFLUENCE_PASSWORD environment variable
+unless --password is given. Prints a JSON summary on stdout, progress and
+diagnostics on stderr, and exits with status 1 when any file failed to
+publish. Files without a Space/Title header are skipped, not failed,
+unless --strict is given.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+abspath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if abspath not in sys.path:
+    sys.path.append(abspath)
+from confluence_core import RENDER_CACHE, ConfluenceApi, FolderPublisher, Markup, PageStore, RetryPolicy, TokenBucket
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        prog="python -m confluence_core.cli",
+        description="Render Markdown/reStructuredText files and publish them to Confluence.")
+    parser.add_argument("paths", nargs="+", help="files or folders to publish")
+    parser.add_argument("--base-uri", default=os.environ.get("CONFLUENCE_BASE_URI"),
+                        help="Confluence REST url base (default: $CONFLUENCE_BASE_URI)")
+    parser.add_argument("--username", default=os.environ.get("CONFLUENCE_USERNAME"),
+                        help="Confluence username (default: $CONFLUENCE_USERNAME)")
+    parser.add_argument("--password", default=os.environ.get("CONFLUENCE_PASSWORD"),
+                        help="Confluence password (default: $CONFLUENCE_PASSWORD)")
+    parser.add_argument("--workers", type=int, default=8, help="pages published in parallel")
+    parser.add_argument("--rate-limit", type=float, default=None,
+                        help="maximum requests per second sent to Confluence")
+    parser.add_argument("--max-retries", type=int, default=4, help="retries of a failed request")
+    parser.add_argument("--compress", action="store_true", help="gzip page payloads")
+    parser.add_argument("--markdown-extras", default="",
+                        help="comma separated markdown2 extras, e.g. fenced-code-blocks,tables")
+    parser.add_argument("--state", default=None,
+                        help="SQLite file remembering page ids and versions between runs")
+    parser.add_argument("--summary", default="-", help="write the JSON summary here (default: stdout)")
+    parser.add_argument("--verbose", action="store_true", help="also log payload sizes and page links")
+    parser.add_argument("--strict", action="store_true",
+                        help="count files without a Space/Title header as failed")
+    args = parser.parse_args(argv)
+    if not (args.base_uri and args.username and args.password):
+        parser.error("--base-uri, --username and --password (or their environment variables) are required")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    logging.basicConfig(stream=sys.stderr, format="%(message)s",
+                        level=logging.DEBUG if args.verbose else logging.INFO)
+    # Only the client's own messages, not every connection urllib3 opens
+    logging.getLogger("urllib3").setLevel(logging.WARNING)
+    started = time.time()
+    confluence_api = ConfluenceApi(
+        args.username, args.password, args.base_uri,
+        pool_size=max(10, args.workers * 2),
+        retry_policy=RetryPolicy(max_retries=args.max_retries),
+        rate_limiter=TokenBucket(args.rate_limit, max(1, args.workers)),
+        compress_requests=args.compress)
+    store = PageStore(os.path.abspath(args.state)) if args.state else None
+    markup = Markup(extras=[extra for extra in args.markdown_extras.split(",") if extra])
+    publisher = FolderPublisher(confluence_api, markup, workers=args.workers, store=store,
+                                progress=lambda message: sys.stderr.write("{}\n".format(message)))
+    results = publisher.publish(args.paths)
+    if args.strict:
+        for result in results:
+            if result["action"] == "skipped":
+                result["ok"] = False
+    failed = [result for result in results if not result["ok"]]
+    skipped = [result for result in results if result["ok"] and result["action"] == "skipped"]
+    summary = dict(published=len(results) - len(failed) - len(skipped), skipped=len(skipped),
+                   failed=len(failed),
+                   requests=confluence_api.request_count,
+                   seconds=round(time.time() - started, 3), render_cache=RENDER_CACHE.stats(),
+                   results=results)
+    output = json.dumps(summary, indent=2, ensure_ascii=False)
+    # UTF-8 whatever the locale, titles need not fit e.g. cp1252 on Windows
+    if args.summary == "-":
+        sys.stdout.flush()
+        sys.stdout.buffer.write((output + "\n").encode("utf-8"))
+        sys.stdout.buffer.flush()
+    else:
+        with open(args.summary, "w", encoding="utf-8") as f:
+            f.write(output)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -102,10 +102,6 @@ __author__ = "Trent Mick"
 import sys
 import re
 import logging
-try:
-    from hashlib import md5
-except ImportError:
-    from md5 import md5
 import optparse
 from random import random, randint
 import codecs
@@ -143,13 +139,13 @@ log = logging.getLogger("markdown")
 DEFAULT_TAB_WIDTH = 4
 
 
-SECRET_SALT = bytes(randint(0, 1000000))
-def _hash_text(s):
-    return 'md5-' + md5(SECRET_SALT + s.encode("utf-8")).hexdigest()
+# Characters hidden behind a placeholder when backslash-escaped:
+g_escape_chars = '\\`*_{}[]()>#+-.!'
 
-# Table of hash values for escaped characters:
-g_escape_table = dict([(ch, _hash_text(ch))
-    for ch in '\\`*_{}[]()>#+-.!'])
+# Placeholders are this random prefix and a fixed width counter, so none
+# is a prefix of another and all are matched by _hash_re:
+g_hash_prefix = "h%08x" % randint(0, 0xffffffff)
+_hash_re = re.compile(g_hash_prefix + "[0-9a-f]{8}")
 
 
 # ---- exceptions
@@ -246,10 +242,35 @@ class Markdown(object):
         self.use_file_vars = use_file_vars
         self._outdent_re = re.compile(r'^(\t|[ ]{1,%d})' % tab_width, re.M)
 
-        self._escape_table = g_escape_table.copy()
+        self._reset_hashes()
+
+    def _reset_hashes(self):
+        self._hashes = {}
+        self._escape_table = dict([(ch, self._hash_text(ch))
+            for ch in g_escape_chars])
         if "smarty-pants" in self.extras:
-            self._escape_table['"'] = _hash_text('"')
-            self._escape_table["'"] = _hash_text("'")
+            self._escape_table['"'] = self._hash_text('"')
+            self._escape_table["'"] = self._hash_text("'")
+
+    def _hash_text(self, s):
+        """Return the placeholder for `s` in the current conversion, the
+        same text always gets the same one.
+        """
+        key = self._hashes.get(s)
+        if key is None:
+            key = "%s%08x" % (g_hash_prefix, len(self._hashes))
+            self._hashes[s] = key
+        return key
+
+    def _unhash(self, text, table):
+        """Replace the placeholders in `text` that `table` maps text to
+        with that text, in one pass.
+        """
+        if not table:
+            return text
+        unhashed = dict([(key, s) for s, key in table.items()])
+        return _hash_re.sub(
+            lambda match: unhashed.get(match.group(0), match.group(0)), text)
 
     def reset(self):
         self.urls = {}
@@ -258,6 +279,7 @@ class Markdown(object):
         self.html_spans = {}
         self.list_level = 0
         self.extras = self._instance_extras.copy()
+        self._reset_hashes()
         if "footnotes" in self.extras:
             self.footnotes = {}
             self.footnote_ids = []
@@ -572,15 +594,15 @@ class Markdown(object):
         return emacs_vars
 
     def _detab_line(self, line):
-        r"""Recusively convert tabs to spaces in a single line.
+        r"""Convert tabs to spaces in a single line.
 
         Called from _detab()."""
         if '\t' not in line:
             return line
-        chunk1, chunk2 = line.split('\t', 1)
-        chunk1 += (' ' * (self.tab_width - len(chunk1) % self.tab_width))
-        output = chunk1 + chunk2
-        return self._detab_line(output)
+        return line.expandtabs(self.tab_width)
+
+    # Line boundaries of str.splitlines() other than '\n'
+    _line_sep_re = re.compile(u'[\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029]')
 
     def _detab(self, text):
         r"""Iterate text line by line and convert tabs to spaces.
@@ -596,9 +618,16 @@ class Markdown(object):
             '  foo'
             >>> m._detab("  foo\n\tbar\tblam")
             '  foo\n    bar blam'
+            >>> m._detab("\tfoo\n\n")
+            '    foo\n'
         """
         if '\t' not in text:
             return text
+        if not self._line_sep_re.search(text):
+            # Only '\n' ends lines: expanding the whole text at once is the
+            # same as joining the expanded lines, less the final newline.
+            text = text.expandtabs(self.tab_width)
+            return text[:-1] if text.endswith('\n') else text
         output = []
         for line in text.splitlines():
             output.append(self._detab_line(line))
@@ -654,14 +683,14 @@ class Markdown(object):
                 middle = '\n'.join(lines[1:-1])
                 last_line = lines[-1]
                 first_line = first_line[:m.start()] + first_line[m.end():]
-                f_key = _hash_text(first_line)
+                f_key = self._hash_text(first_line)
                 self.html_blocks[f_key] = first_line
-                l_key = _hash_text(last_line)
+                l_key = self._hash_text(last_line)
                 self.html_blocks[l_key] = last_line
                 return ''.join(["\n\n", f_key,
                     "\n\n", middle, "\n\n",
                     l_key, "\n\n"])
-        key = _hash_text(html)
+        key = self._hash_text(html)
         self.html_blocks[key] = html
         return "\n\n" + key + "\n\n"
 
@@ -756,7 +785,7 @@ class Markdown(object):
                 html = text[start_idx:end_idx]
                 if raw and self.safe_mode:
                     html = self._sanitize_html(html)
-                key = _hash_text(html)
+                key = self._hash_text(html)
                 self.html_blocks[key] = html
                 text = text[:start_idx] + "\n\n" + key + "\n\n" + text[end_idx:]
 
@@ -1178,7 +1207,7 @@ class Markdown(object):
         for token in self._sorta_html_tokenize_re.split(text):
             if is_html_markup and not _is_auto_link(token):
                 sanitized = self._sanitize_html(token)
-                key = _hash_text(sanitized)
+                key = self._hash_text(sanitized)
                 self.html_spans[key] = sanitized
                 tokens.append(key)
             else:
@@ -1187,9 +1216,8 @@ class Markdown(object):
         return ''.join(tokens)
 
     def _unhash_html_spans(self, text):
-        for key, sanitized in list(self.html_spans.items()):
-            text = text.replace(key, sanitized)
-        return text
+        return self._unhash(text, dict([(sanitized, key)
+            for key, sanitized in self.html_spans.items()]))
 
     def _sanitize_html(self, s):
         if self.safe_mode == "replace":
@@ -1888,7 +1916,7 @@ class Markdown(object):
         ]
         for before, after in replacements:
             text = text.replace(before, after)
-        hashed = _hash_text(text)
+        hashed = self._hash_text(text)
         self._escape_table[text] = hashed
         return hashed
 
@@ -2179,18 +2207,15 @@ class Markdown(object):
                         .replace('*', self._escape_table['*'])
                         .replace('_', self._escape_table['_']))
                 link = '<a href="%s">%s</a>' % (escaped_href, text[start:end])
-                hash = _hash_text(link)
+                hash = self._hash_text(link)
                 link_from_hash[hash] = link
                 text = text[:start] + hash + text[end:]
-        for hash, link in list(link_from_hash.items()):
-            text = text.replace(hash, link)
-        return text
+        return self._unhash(text, dict([(link, hash)
+            for hash, link in link_from_hash.items()]))
 
     def _unescape_special_chars(self, text):
         # Swap back in all the special characters we've hidden.
-        for ch, hash in list(self._escape_table.items()):
-            text = text.replace(hash, ch)
-        return text
+        return self._unhash(text, self._escape_table)
 
     def _outdent(self, text):
         # Remove one level of line-leading tabs or spaces